@@ -0,0 +1,260 @@
+"""
+A local stand-in for the OpenBMCLAPI central server, and for AList.
+
+    python bench/central.py --port 18900 --alist-port 18901 --files 20000
+
+Serves what a node needs from the central server: the agent challenge and
+token, the configuration, a generated zstd file list, the files themselves
+and the socket.io enable, keep-alive, disable and request-cert events. File
+sizes follow a log-normal distribution and contents are derived from
+--seed, so every run serves the same files. GET /bench/files lists them as
+JSON for the load generator.
+
+With --alist-port an in-memory AList is served as well, for nodes that use
+an alist storage.
+"""
+
+from typing import Dict, List, Tuple
+import argparse
+import asyncio
+import hashlib
+import hmac
+import math
+import random
+import time
+
+from aiohttp import web
+import socketio
+import zstandard
+
+TOKEN_TTL = 24 * 3600 * 1000
+
+
+def writeLong(value: int) -> bytes:
+    value = (value << 1) ^ (value >> 63)
+    result = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if not value:
+            result.append(byte)
+            return bytes(result)
+        result.append(byte | 0x80)
+
+
+def writeString(value: str) -> bytes:
+    data = value.encode()
+    return writeLong(len(data)) + data
+
+
+class Files:
+    def __init__(self, count: int, median: int, sigma: float, seed: int) -> None:
+        self.seed = seed
+        rng = random.Random(seed)
+        self.sizes = [
+            max(1, min(int(rng.lognormvariate(math.log(median), sigma)), 256 << 20))
+            for _ in range(count)
+        ]
+        self.entries: List[Tuple[str, str, int]] = []
+        self.paths: Dict[str, int] = {}
+        for index, size in enumerate(self.sizes):
+            path = f"/files/{index}"
+            self.entries.append(
+                (path, hashlib.sha1(self.read(index)).hexdigest(), size)
+            )
+            self.paths[path] = index
+        self.mtime = int(time.time() * 1000)
+
+    def read(self, index: int) -> bytes:
+        return random.Random(self.seed * 1_000_003 + index).randbytes(self.sizes[index])
+
+    def filelist(self) -> bytes:
+        body = bytearray(writeLong(len(self.entries)))
+        for path, hash, size in self.entries:
+            body += writeString(path) + writeString(hash)
+            body += writeLong(size) + writeLong(self.mtime)
+        return zstandard.ZstdCompressor().compress(bytes(body))
+
+
+def createCentral(args: argparse.Namespace, files: Files) -> web.Application:
+    app = web.Application()
+    routes = web.RouteTableDef()
+    sio = socketio.AsyncServer(async_mode="aiohttp")
+    sio.attach(app)
+    filelist = files.filelist()
+    delay = args.latency / 1000
+
+    @routes.get("/openbmclapi-agent/challenge")
+    async def _(request: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+        return web.json_response({"challenge": request.query.get("clusterId", "")})
+
+    @routes.post("/openbmclapi-agent/token")
+    async def _(request: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+        data = await request.json()
+        signature = hmac.new(
+            args.secret.encode(), data["challenge"].encode(), hashlib.sha256
+        ).hexdigest()
+        if not hmac.compare_digest(signature, data["signature"]):
+            return web.json_response({"message": "invalid signature"}, status=403)
+        return web.json_response({"token": "bench", "ttl": TOKEN_TTL})
+
+    @routes.get("/openbmclapi/configuration")
+    async def _(_: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+        return web.json_response(
+            {"sync": {"source": "center", "concurrency": args.concurrency}}
+        )
+
+    @routes.get("/openbmclapi/files")
+    async def _(_: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+        return web.Response(body=filelist)
+
+    @routes.get("/files/{index}")
+    async def _(request: web.Request) -> web.Response:
+        index = files.paths.get(request.path)
+        if index is None:
+            return web.HTTPNotFound()
+        await asyncio.sleep(delay)
+        return web.Response(body=files.read(index))
+
+    @routes.get("/bench/files")
+    async def _(_: web.Request) -> web.Response:
+        return web.json_response([[hash, size] for _, hash, size in files.entries])
+
+    @sio.on("enable")
+    async def _(sid: str, data: dict) -> list:
+        await asyncio.sleep(delay)
+        return [None, True]
+
+    @sio.on("keep-alive")
+    async def _(sid: str, data: dict) -> list:
+        return [None, data.get("time")]
+
+    @sio.on("disable")
+    async def _(sid: str, data: dict | None = None) -> list:
+        return [None, True]
+
+    @sio.on("request-cert")
+    async def _(sid: str, data: dict | None = None) -> list:
+        if not args.cert or not args.key:
+            return [{"message": "no certificate, start with --cert and --key"}]
+        with open(args.cert) as cert, open(args.key) as key:
+            return [None, {"cert": cert.read(), "key": key.read()}]
+
+    app.add_routes(routes)
+    return app
+
+
+def createAList(port: int) -> web.Application:
+    app = web.Application(client_max_size=1 << 30)
+    routes = web.RouteTableDef()
+    store: Dict[str, bytes] = {}
+
+    def ok(data=None) -> web.Response:
+        return web.json_response({"code": 200, "message": "success", "data": data})
+
+    def normalize(path: str) -> str:
+        return "/" + "/".join(part for part in path.split("/") if part)
+
+    @routes.post("/api/auth/login")
+    async def _(_: web.Request) -> web.Response:
+        return ok({"token": "bench"})
+
+    @routes.put("/api/fs/put")
+    async def _(request: web.Request) -> web.Response:
+        store[normalize(request.headers["File-Path"])] = await request.read()
+        return ok()
+
+    @routes.post("/api/fs/get")
+    async def _(request: web.Request) -> web.Response:
+        path = normalize((await request.json())["path"])
+        if path not in store:
+            return web.json_response({"code": 500, "message": "object not found"})
+        return ok(
+            {
+                "size": len(store[path]),
+                "raw_url": f"http://127.0.0.1:{port}/d{path}",
+            }
+        )
+
+    @routes.post("/api/fs/list")
+    async def _(request: web.Request) -> web.Response:
+        prefix = normalize((await request.json())["path"]) + "/"
+        content = [
+            {"name": path[len(prefix) :], "size": len(data), "is_dir": False}
+            for path, data in store.items()
+            if path.startswith(prefix) and "/" not in path[len(prefix) :]
+        ]
+        return ok({"content": content, "total": len(content)})
+
+    @routes.post("/api/fs/remove")
+    async def _(request: web.Request) -> web.Response:
+        data = await request.json()
+        for name in data["names"]:
+            store.pop(normalize(f"{data['dir']}/{name}"), None)
+        return ok()
+
+    @routes.get("/d/{path:.+}")
+    async def _(request: web.Request) -> web.Response:
+        data = store.get(normalize(request.match_info["path"]))
+        if data is None:
+            return web.HTTPNotFound()
+        return web.Response(body=data)
+
+    app.add_routes(routes)
+    return app
+
+
+async def serve(args: argparse.Namespace) -> None:
+    start = time.perf_counter()
+    files = Files(args.files, args.median_size, args.sigma, args.seed)
+    print(
+        f"{len(files.entries)} files, {sum(files.sizes) / 1024 / 1024:.1f} MiB, "
+        f"generated in {time.perf_counter() - start:.1f}s",
+        flush=True,
+    )
+    runners = []
+    apps = [(createCentral(args, files), args.port)]
+    if args.alist_port:
+        apps.append((createAList(args.alist_port), args.alist_port))
+    for app, port in apps:
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+    print(f"listening on {', '.join(str(port) for _, port in apps)}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=18900)
+    parser.add_argument("--alist-port", type=int, default=0)
+    parser.add_argument("--secret", default="bench")
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--median-size", type=int, default=16 * 1024)
+    parser.add_argument("--sigma", type=float, default=1.5, help="size spread")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0, help="added ms")
+    parser.add_argument("--cert", help="certificate returned by request-cert")
+    parser.add_argument("--key", help="private key returned by request-cert")
+    return parser
+
+
+def main() -> None:
+    try:
+        asyncio.run(serve(parser().parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Load test a running node.
+
+    python bench/loadtest.py --url http://127.0.0.1:8800 --secret <secret> \
+        --cache ./cache --concurrency 64 --duration 30 --output uvloop.json
+
+Run it once per configuration change and pass the previous result with
+--baseline to print what the change is worth on this machine.
+"""
+
+from pathlib import Path
+from typing import Dict, List
+import argparse
+import asyncio
+import base64
+import hashlib
+import itertools
+import json
+import random
+import time
+
+import aiohttp
+
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def toBase36(value: int) -> str:
+    result = ""
+    while value:
+        value, digit = divmod(value, 36)
+        result = DIGITS[digit] + result
+    return result or "0"
+
+
+def sign(secret: str, subject: str, ttl: int = 3600) -> str:
+    e = toBase36(int(time.time()) + ttl)
+    s = (
+        base64.urlsafe_b64encode(
+            hashlib.sha1(f"{secret}{subject}{e}".encode()).digest()
+        )
+        .decode()
+        .rstrip("=")
+    )
+    return f"s={s}&e={e}"
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def zipfWeights(count: int, exponent: float) -> List[float]:
+    return [1 / (rank**exponent) for rank in range(1, count + 1)]
+
+
+def discoverHashes(cache: str) -> List[str]:
+    return [
+        file.name
+        for file in Path(cache).glob("*/*")
+        if file.is_file() and len(file.parent.name) == 2
+    ]
+
+
+async def fetchHashes(central: str) -> List[str]:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{central}/bench/files") as response:
+            return [hash for hash, _ in await response.json()]
+
+
+async def run(
+    url: str,
+    secret: str,
+    hashes: List[str],
+    concurrency: int,
+    duration: float,
+    exponent: float,
+) -> Dict[str, float]:
+    weights = list(itertools.accumulate(zipfWeights(len(hashes), exponent)))
+    latencies: List[float] = []
+    errors = 0
+    received = 0
+    deadline = time.perf_counter() + duration
+
+    async def client(session: aiohttp.ClientSession) -> None:
+        nonlocal errors, received
+        while time.perf_counter() < deadline:
+            hash = random.choices(hashes, cum_weights=weights)[0]
+            start = time.perf_counter()
+            try:
+                async with session.get(
+                    f"/download/{hash}?{sign(secret, hash)}",
+                    headers={"User-Agent": "openbmclapi-loadtest/1.0"},
+                ) as response:
+                    received += len(await response.read())
+                    if response.status != 200:
+                        errors += 1
+                        continue
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    async with aiohttp.ClientSession(
+        url, connector=aiohttp.TCPConnector(limit=concurrency)
+    ) as session:
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "throughput": received / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p90": percentile(latencies, 0.9),
+        "p99": percentile(latencies, 0.99),
+        "max": max(latencies, default=0.0),
+    }
+
+
+def report(result: Dict[str, float], baseline: Dict[str, float] | None) -> None:
+    rows = [
+        ("requests", "requests", "{:.0f}"),
+        ("errors", "errors", "{:.0f}"),
+        ("requests/s", "rps", "{:.1f}"),
+        ("MiB/s", "throughput", "{:.2f}"),
+        ("p50 ms", "p50", "{:.2f}"),
+        ("p90 ms", "p90", "{:.2f}"),
+        ("p99 ms", "p99", "{:.2f}"),
+        ("max ms", "max", "{:.2f}"),
+    ]
+    scale = {
+        "throughput": 1 / 1024 / 1024,
+        "p50": 1000,
+        "p90": 1000,
+        "p99": 1000,
+        "max": 1000,
+    }
+    for label, key, fmt in rows:
+        value = result[key] * scale.get(key, 1)
+        line = f"{label:>12}  {fmt.format(value):>12}"
+        if baseline and baseline.get(key):
+            old = baseline[key] * scale.get(key, 1)
+            line += f"  {fmt.format(old):>12}  {(value - old) / old * 100:+.1f}%"
+        print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", default="http://127.0.0.1:8800")
+    parser.add_argument("--secret", required=True)
+    parser.add_argument(
+        "--cache", default="./cache", help="local storage to pick hashes from"
+    )
+    parser.add_argument("--hashes", help="file with one hash per line")
+    parser.add_argument("--central", help="bench/central.py to list files from")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--zipf", type=float, default=1.1, help="popularity skew")
+    parser.add_argument("--output", help="write the result as JSON")
+    parser.add_argument("--baseline", help="compare with a previous JSON result")
+    args = parser.parse_args()
+
+    if args.central:
+        hashes = asyncio.run(fetchHashes(args.central))
+    elif args.hashes:
+        hashes = Path(args.hashes).read_text().split()
+    else:
+        hashes = discoverHashes(args.cache)
+    if not hashes:
+        parser.error("no files to request, use --cache, --hashes or --central")
+    random.shuffle(hashes)
+
+    result = asyncio.run(
+        run(args.url, args.secret, hashes, args.concurrency, args.duration, args.zipf)
+    )
+    baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+    report(result, baseline)
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
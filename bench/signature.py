@@ -0,0 +1,73 @@
+"""
+Microbenchmark of signed URL verification.
+
+    python bench/signature.py --urls 1000 --requests 200000
+
+Compares the previous per-request implementation with core.signature.Signer,
+both for repeated URLs (served from its cache) and for URLs seen only once.
+"""
+
+from pathlib import Path
+import argparse
+import base64
+import hashlib
+import importlib.util
+import os
+import time
+import timeit
+
+# Importing the core package starts a cluster, load the module on its own.
+spec = importlib.util.spec_from_file_location(
+    "signature", Path(__file__).resolve().parent.parent / "core" / "signature.py"
+)
+signature = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(signature)
+Signer = signature.Signer
+
+SECRET = "0123456789abcdef0123456789abcdef"
+
+
+def legacy(hash: str, secret: str, s: str, e: str) -> bool:
+    sign = (
+        base64.urlsafe_b64encode(hashlib.sha1(f"{secret}{hash}{e}".encode()).digest())
+        .decode()
+        .rstrip("=")
+    )
+    return sign == s and time.time() < int(e, 36)
+
+
+def measure(label: str, fn, urls, requests: int) -> float:
+    count = len(urls)
+    index = iter(range(requests))
+
+    def step() -> None:
+        hash, s, e = urls[next(index) % count]
+        assert fn(hash, s, e)
+
+    elapsed = timeit.timeit(step, number=requests)
+    rate = requests / elapsed
+    print(f"{label:>24} {rate:>12,.0f}/s {elapsed / requests * 1e9:>8.0f} ns")
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--urls", type=int, default=1000, help="distinct URLs")
+    parser.add_argument("--requests", type=int, default=200000)
+    args = parser.parse_args()
+
+    signer = Signer(SECRET, args.urls)
+    expires = int(time.time()) + 3600
+    urls = []
+    for _ in range(args.urls):
+        hash = os.urandom(20).hex()
+        urls.append((hash, *signer.sign(hash, expires)))
+
+    measure("legacy", lambda h, s, e: legacy(h, SECRET, s, e), urls, args.requests)
+    uncached = Signer(SECRET, 0)
+    measure("signer, no cache", uncached.verify, urls, args.requests)
+    measure("signer, repeated urls", signer.verify, urls, args.requests)
+
+
+if __name__ == "__main__":
+    main()
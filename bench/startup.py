@@ -0,0 +1,145 @@
+"""
+Measure how long a node takes to start.
+
+    python bench/startup.py --cwd /srv/openbmclapi --runs 5 --output before.json
+
+Every run starts main.py in --cwd, waits until the port accepts connections
+and until the node reports itself enabled on /metrics, then stops it with
+SIGTERM. The node must be able to reach its central server (or a mock of
+it). Pass a previous result with --baseline to compare.
+"""
+
+from pathlib import Path
+from typing import Dict, List
+import argparse
+import asyncio
+import json
+import re
+import signal
+import ssl
+import statistics
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+ENABLED = re.compile(r'openbmclapi_startup_seconds\{phase="enabled"\} ([0-9.e+-]+)')
+LISTENING = re.compile(r'openbmclapi_startup_seconds\{phase="listening"\} ([0-9.e+-]+)')
+
+
+def importTime(cwd: str, python: str) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [python, "-c", "import core"], cwd=cwd, check=True, capture_output=True
+    )
+    return time.perf_counter() - start
+
+
+async def waitListening(port: int, deadline: float) -> None:
+    while time.perf_counter() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.02)
+    raise TimeoutError("node did not start listening")
+
+
+async def waitEnabled(port: int, deadline: float) -> Dict[str, float]:
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() < deadline:
+            for scheme in ("http", "https"):
+                try:
+                    async with session.get(
+                        f"{scheme}://127.0.0.1:{port}/metrics",
+                        ssl=context if scheme == "https" else None,
+                    ) as response:
+                        text = await response.text()
+                except aiohttp.ClientError:
+                    continue
+                enabled = ENABLED.search(text)
+                listening = LISTENING.search(text)
+                if enabled and listening:
+                    return {
+                        "node_listening": float(listening.group(1)),
+                        "node_enabled": float(enabled.group(1)),
+                    }
+            await asyncio.sleep(0.1)
+    raise TimeoutError("node was not enabled")
+
+
+async def run(cwd: str, python: str, port: int, timeout: float) -> Dict[str, float]:
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [python, "main.py"],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = start + timeout
+        await waitListening(port, deadline)
+        listening = time.perf_counter() - start
+        result = await waitEnabled(port, deadline)
+        return {"listening": listening, **result}
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def summarize(runs: List[Dict[str, float]], imports: List[float]) -> Dict[str, float]:
+    result = {"import": statistics.median(imports)}
+    for key in runs[0]:
+        result[key] = statistics.median(run[key] for run in runs)
+    return result
+
+
+def report(result: Dict[str, float], baseline: Dict[str, float] | None) -> None:
+    rows = [
+        ("import core", "import"),
+        ("listening", "listening"),
+        ("listening*", "node_listening"),
+        ("enabled*", "node_enabled"),
+    ]
+    for label, key in rows:
+        line = f"{label:>12}  {result[key]:>10.3f}s"
+        if baseline and baseline.get(key):
+            old = baseline[key]
+            line += f"  {old:>10.3f}s  {(result[key] - old) / old * 100:+.1f}%"
+        print(line)
+    print("* as reported by the node, measured from process start")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--cwd", default=".", help="node directory with main.py")
+    parser.add_argument("--python", default=sys.executable)
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--output", help="write the result as JSON")
+    parser.add_argument("--baseline", help="compare with a previous JSON result")
+    args = parser.parse_args()
+
+    imports = [importTime(args.cwd, args.python) for _ in range(args.runs)]
+    runs = [
+        asyncio.run(run(args.cwd, args.python, args.port, args.timeout))
+        for _ in range(args.runs)
+    ]
+    result = summarize(runs, imports)
+    baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+    report(result, baseline)
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
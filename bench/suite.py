@@ -0,0 +1,224 @@
+"""
+Benchmark a node end to end against the local mock central server.
+
+    python bench/suite.py --storages local,pack,alist --files 5000 \
+        --duration 30 --output before.json
+
+Starts bench/central.py (with its AList stand-in), then for every storage
+runs a fresh node from --node in a temporary directory. Each node syncs the
+generated files and enables. It is then loaded with signed downloads that
+follow a Zipf popularity distribution. Reported per storage: requests/s,
+p50/p99 latency, resident memory after the load, sync duration and file
+list parse time. Pass a previous result with --baseline to compare.
+"""
+
+from pathlib import Path
+from typing import Dict, List
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from loadtest import fetchHashes, run as loadtest
+from startup import waitEnabled, waitListening
+
+SECRET = "bench"
+SHARED = ("i18n", "assets", "pyproject.toml")
+ROWS = [
+    ("requests/s", "rps", 1, "{:.1f}"),
+    ("p50 ms", "p50", 1000, "{:.2f}"),
+    ("p99 ms", "p99", 1000, "{:.2f}"),
+    ("errors", "errors", 1, "{:.0f}"),
+    ("RSS MiB", "rss", 1 / 1024 / 1024, "{:.1f}"),
+    ("sync s", "sync", 1, "{:.2f}"),
+    ("parse ms", "parse", 1000, "{:.2f}"),
+    ("enabled s", "node_enabled", 1, "{:.2f}"),
+]
+
+
+def storageConfig(kind: str, alist: str, cache_size: int) -> Dict:
+    remote = {
+        "type": "alist",
+        "url": alist,
+        "username": "bench",
+        "password": "bench",
+        # The AList stand-in is shared by every run.
+        "path": f"/bench-{kind}-{int(time.time())}",
+    }
+    if kind == "alist":
+        return remote
+    if kind == "tiered":
+        return {
+            "type": "tiered",
+            "path": "./cache",
+            "size": cache_size,
+            "origin": remote,
+        }
+    return {"type": kind, "path": "./cache"}
+
+
+def scrape(text: str, name: str) -> float:
+    match = re.search(rf"^{name}(?:{{[^}}]*}})? ([0-9.e+-]+)$", text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+
+async def metrics(port: int) -> str:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+            return await response.text()
+
+
+async def bench(
+    args: argparse.Namespace, kind: str, hashes: List[str]
+) -> Dict[str, float]:
+    central = f"http://127.0.0.1:{args.port}"
+    alist = f"http://127.0.0.1:{args.port + 1}"
+    with tempfile.TemporaryDirectory(prefix=f"bench-{kind}-") as cwd:
+        for name in SHARED:
+            if (Path(args.node) / name).exists():
+                os.symlink(Path(args.node).resolve() / name, Path(cwd) / name)
+        os.makedirs(Path(cwd) / "config")
+        config = {
+            "cluster": {
+                "id": "bench",
+                "secret": SECRET,
+                "base_url": central,
+                "host": "127.0.0.1",
+                "port": args.node_port,
+                "byoc": True,
+            },
+            "storages": [storageConfig(kind, alist, args.cache_size)],
+            "advanced": {"sync_interval": 1440, "scrub": {"rate": 0}},
+        }
+        # JSON is valid YAML.
+        (Path(cwd) / "config" / "config.yml").write_text(json.dumps(config))
+
+        process = subprocess.Popen(
+            [sys.executable, str(Path(args.node).resolve() / "main.py")],
+            cwd=cwd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            deadline = time.perf_counter() + args.timeout
+            await waitListening(args.node_port, deadline)
+            result = await waitEnabled(args.node_port, deadline)
+            result.update(
+                await loadtest(
+                    f"http://127.0.0.1:{args.node_port}",
+                    SECRET,
+                    hashes,
+                    args.concurrency,
+                    args.duration,
+                    args.zipf,
+                )
+            )
+            text = await metrics(args.node_port)
+            result["rss"] = scrape(text, "openbmclapi_process_resident_memory_bytes")
+            result["sync"] = scrape(text, "openbmclapi_sync_duration_seconds")
+            result["parse"] = scrape(text, "openbmclapi_filelist_parse_seconds")
+            return result
+        finally:
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(60)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def report(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]] | None,
+) -> None:
+    kinds = list(results)
+    print(f"{'':>12}" + "".join(f"{kind:>14}" for kind in kinds))
+    for label, key, scale, fmt in ROWS:
+        line = f"{label:>12}"
+        for kind in kinds:
+            value = results[kind].get(key, 0.0) * scale
+            cell = fmt.format(value)
+            old = (baseline or {}).get(kind, {}).get(key)
+            if old:
+                cell += f" {(value - old * scale) / (old * scale) * 100:+.0f}%"
+            line += f"{cell:>14}"
+        print(line)
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    central = subprocess.Popen(
+        [
+            sys.executable,
+            str(Path(__file__).with_name("central.py")),
+            "--port",
+            str(args.port),
+            "--alist-port",
+            str(args.port + 1),
+            "--secret",
+            SECRET,
+            "--files",
+            str(args.files),
+            "--median-size",
+            str(args.median_size),
+            "--seed",
+            str(args.seed),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert central.stdout is not None
+        for line in central.stdout:
+            print(f"central: {line.rstrip()}")
+            if line.startswith("listening"):
+                break
+        hashes = await fetchHashes(f"http://127.0.0.1:{args.port}")
+        random.Random(args.seed).shuffle(hashes)
+        results = {}
+        for kind in args.storages.split(","):
+            print(f"{kind}: running", flush=True)
+            results[kind] = await bench(args, kind, hashes)
+        return results
+    finally:
+        central.terminate()
+        central.wait()
+
+
+def parse() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--node", default=str(Path(__file__).resolve().parent.parent))
+    parser.add_argument(
+        "--storages",
+        default="local,pack,alist,tiered",
+        help="comma separated: local, pack, alist, tiered",
+    )
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--median-size", type=int, default=16 * 1024)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cache-size", type=int, default=64 << 20)
+    parser.add_argument("--port", type=int, default=18900)
+    parser.add_argument("--node-port", type=int, default=18980)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--zipf", type=float, default=1.1, help="popularity skew")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--output", help="write the result as JSON")
+    parser.add_argument("--baseline", help="compare with a previous JSON result")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse()
+    results = asyncio.run(main(args))
+    baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+    report(results, baseline)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
@@ -1,20 +1,34 @@
 import asyncio
 from core.cluster import Cluster
 from core.config import Config
+from core.exceptions import ConfigValueError
 from core.logger import logger
 from core.scheduler import scheduler, IntervalTrigger
-from core import orm
+from core import orm, metrics
+from core.profiler import profiler
+from core.workers import WorkerPool, reusePortSupported
+from core.performance import loopFactory, checkAccelerations
 import os
+import signal
+import time
 
 cluster = Cluster()
 
 
 async def main() -> None:
+    loop_lag_monitor: asyncio.Task | None = None
     try:
-        await cluster.token.fetchToken()
-        await cluster.getConfiguration()
-        await cluster.init()
-        await cluster.checkStorages()
+        task = asyncio.current_task()
+        assert task is not None
+        try:
+            # Stop gracefully when systemd or a supervisor asks us to.
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reloadConfig)
+        except (NotImplementedError, AttributeError):
+            pass
+        profiler.install(asyncio.get_running_loop())
+        checkAccelerations()
+        loop_lag_monitor = asyncio.create_task(metrics.monitorLoopLag())
         logger.tinfo("orm.info.creating")
         try:
             os.makedirs("./database", exist_ok=True)
@@ -23,41 +37,106 @@ async def main() -> None:
         except Exception as e:
             logger.terror("orm.error.failed", e=e)
 
-        async def syncFiles() -> None:
+        async def prepareStorages() -> None:
+            await cluster.init()
+            await cluster.checkStorages()
+
+        async def syncFiles(ready: asyncio.Event | None = None) -> None:
+            # Another node keeps the shared storage in sync.
+            if await cluster.coordinator.follow():
+                return
             if cluster.scheduler:
                 cluster.scheduler.pause()
             if cluster.enabled and cluster.socket:
                 await cluster.disable()
             await cluster.fetchFileList()
             missing_filelist = await cluster.getMissingFiles()
-            await cluster.syncFiles(
-                missing_filelist,
-                Config.get("advanced.retry"),
-                Config.get("advanced.delay"),
+            plan = cluster.planSync(missing_filelist)
+            start = time.perf_counter()
+            syncing = asyncio.create_task(
+                cluster.syncFiles(
+                    plan.files,
+                    Config.settings.advanced.retry,
+                    Config.settings.advanced.delay,
+                )
             )
-            # asyncio.create_task(cluster.recycleFiles())
-            if not cluster.enabled and cluster.socket:
+            # Serve once enough of the expected requests are covered, the
+            # remaining files keep downloading.
+            covered = asyncio.create_task(plan.ready.wait())
+            await asyncio.wait((syncing, covered), return_when=asyncio.FIRST_COMPLETED)
+            covered.cancel()
+            if plan.pending and not syncing.done():
+                logger.tinfo(
+                    "cluster.info.sync_files.coverage",
+                    coverage=round(plan.coverage * 100, 1),
+                    count=len(plan.pending),
+                )
+            if not cluster.enabled and cluster.want_enable:
                 await cluster.enable()
+            # The node may serve again, it has to keep reporting while the
+            # rest of the files download.
             if cluster.scheduler:
                 cluster.scheduler.resume()
+            if ready:
+                ready.set()
+            await syncing
+            cluster.plan = None
+            metrics.sync_duration.set(time.perf_counter() - start)
+            await cluster.coordinator.publish()
+            # asyncio.create_task(cluster.recycleFiles())
 
-        await syncFiles()
+        async def serve() -> None:
+            await cluster.connect()
+            protocol = "http" if Config.settings.cluster.byoc else "https"
+            if protocol == "https":
+                await cluster.requestCertificate()
+            await cluster.setupRouter()
+            worker_count = Config.settings.advanced.workers
+            if worker_count > 0 and not reusePortSupported():
+                logger.twarning("workers.warn.unsupported")
+            elif worker_count > 0:
+                cluster.workers = WorkerPool(worker_count, cluster.router)
+            await cluster.listen(
+                protocol == "https",
+                Config.settings.cluster.port,
+                reuse_port=cluster.workers is not None,
+            )
+            if cluster.workers:
+                cluster.workers.start(protocol == "https", Config.settings.cluster.port)
+                scheduler.add_job(
+                    cluster.workers.supervise, IntervalTrigger(seconds=10)
+                )
+            metrics.startup_duration.labels("listening").set(uptime())
+
+        # Storages don't depend on the token, and the socket, certificate and
+        # listener don't depend on the file list, so they run alongside the
+        # sync. Only enabling has to wait for all of them.
+        storages = asyncio.create_task(prepareStorages())
+        await cluster.token.fetchToken()
+        serving = asyncio.create_task(serve())
+        await asyncio.gather(
+            cluster.getConfiguration(), storages, cluster.coordinator.start()
+        )
+        ready = asyncio.Event()
+        await waitReady(asyncio.create_task(syncFiles(ready)), ready)
         scheduler.add_job(
             syncFiles,
-            trigger=IntervalTrigger(minutes=Config.get("advanced.sync_interval")),
+            trigger=IntervalTrigger(minutes=Config.settings.advanced.sync_interval),
             max_instances=50,
         )
-        await cluster.connect()
-        protocol = "http" if Config.get("cluster.byoc") else "https"
-        if protocol == "https":
-            await cluster.requestCertificate()
-        await cluster.setupRouter()
-        await cluster.listen(protocol == "https", Config.get("cluster.port"))
+        await serving
         await cluster.enable()
         cluster.want_enable = True
         if not cluster.enabled:
             raise asyncio.CancelledError
+        metrics.startup_duration.labels("enabled").set(uptime())
+        logger.tinfo(
+            "main.info.startup",
+            listening=round(metrics.startup_duration.labels("listening").get(), 2),
+            enabled=round(uptime(), 2),
+        )
         scheduler.start()
+        cluster.scrubber.start()
         await cluster.keepAlive()
         logger.tsuccess("main.success.scheduler")
         while True:
@@ -65,20 +144,68 @@ async def main() -> None:
 
     except asyncio.CancelledError:
         logger.tinfo("main.info.stopping")
+        cluster.scrubber.stop()
+        await cluster.coordinator.stop()
         if cluster.enabled:
             cluster.want_enable = False
             await cluster.disable()
-        if cluster.socket:
-            await cluster.socket.disconnect()
-        if cluster.site:
-            await cluster.site.stop()
+        # Central stops sending clients once disabled, let the transfers that
+        # are already running finish before the listeners go away.
+        drains = [cluster.drain()]
+        if cluster.workers:
+            drains.append(
+                cluster.workers.stop(Config.settings.advanced.drain_timeout + 5)
+            )
+        await asyncio.gather(*drains)
+        cluster.flushHits()
+        await cluster.close()
+        if cluster.router:
+            await cluster.router.saveHotFiles()
+            await cluster.router.saveAgents()
         if scheduler.state == 1:
             scheduler.shutdown()
+        if loop_lag_monitor:
+            loop_lag_monitor.cancel()
         logger.tsuccess("main.success.stopped")
 
 
+async def waitReady(task: asyncio.Task, ready: asyncio.Event) -> None:
+    """
+    Returns once `ready` is set, or raises if `task` fails before that. A
+    task still running afterwards logs its own failure.
+    """
+    waiter = asyncio.create_task(ready.wait())
+    await asyncio.wait((task, waiter), return_when=asyncio.FIRST_COMPLETED)
+    waiter.cancel()
+    if task.done():
+        task.result()
+    else:
+        task.add_done_callback(logFailure)
+
+
+def logFailure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.terror("main.error.background", e=task.exception())
+
+
+def uptime() -> float:
+    import psutil
+
+    return time.time() - psutil.Process(os.getpid()).create_time()
+
+
+def reloadConfig() -> None:
+    if not cluster.router:
+        return
+    try:
+        cluster.router.reloadConfig()
+    except ConfigValueError:
+        pass
+
+
 def init():
     try:
-        asyncio.run(main())
+        with asyncio.Runner(loop_factory=loopFactory()) as runner:
+            runner.run(main())
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,67 @@
+from core import metrics
+from collections import deque
+from typing import Deque
+import asyncio
+
+rejected = metrics.registry.counter(
+    "openbmclapi_admission_rejected_total",
+    "Downloads refused because the transfer limit and its queue were full.",
+)
+queued = metrics.registry.gauge(
+    "openbmclapi_admission_queued",
+    "Downloads waiting for a free transfer slot.",
+)
+
+
+class Admission:
+    """
+    Bounds the number of concurrent transfers.
+
+    Up to `limit` requests run at once, up to `queue` more wait for at most
+    `timeout` seconds in FIFO order, and everything beyond that is refused.
+    A limit of 0 admits everything but still counts what is in flight.
+    """
+
+    def __init__(self, limit: int, queue: int, timeout: float) -> None:
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        queued.setFunction(lambda: len(self.waiters))
+
+    async def acquire(self) -> bool:
+        if not self.limit or (self.active < self.limit and not self.waiters):
+            self.active += 1
+            return True
+        if len(self.waiters) >= self.queue:
+            rejected.inc()
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        try:
+            await asyncio.wait_for(future, self.timeout)
+            return True
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                return True
+            rejected.inc()
+            return False
+        except asyncio.CancelledError:
+            # The slot may have been handed over right before cancellation.
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            if future in self.waiters:
+                self.waiters.remove(future)
+
+    def release(self) -> None:
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                # Hand the slot straight to the next waiter.
+                future.set_result(None)
+                return
+        self.active -= 1
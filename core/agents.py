@@ -0,0 +1,51 @@
+from typing import Dict, Union
+import re
+
+OTHER = "other"
+IGNORED = ("bmclapi-ctrl", "bmclapi-warden")
+FAMILY = re.compile(r"([\w.+-]{1,32})/v?(\d+)(?:\.(\d+))?")
+
+
+def normalizeAgent(agent: str) -> Union[str, None]:
+    """
+    Reduces a User-Agent to its product and major.minor version, e.g.
+    `PCL2/2.8.3.1 (Windows 10)` to `PCL2/2.8`. Returns None for the central
+    server's own probes and OTHER when there is no product/version.
+    """
+    match = FAMILY.match(agent)
+    if not match:
+        return OTHER
+    product, major, minor = match.groups()
+    if product in IGNORED:
+        return None
+    return f"{product}/{major}.{minor}" if minor else f"{product}/{major}"
+
+
+class AgentStats:
+    """
+    Counts requests per user-agent family in memory until they are flushed.
+    At most `capacity` families are tracked between flushes, further ones
+    are counted as OTHER.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.pending: Dict[str, int] = {}
+
+    def add(self, agent: str) -> None:
+        family = normalizeAgent(agent)
+        if family is not None:
+            self.count(family, 1)
+
+    def count(self, family: str, hits: int) -> None:
+        if family not in self.pending and len(self.pending) >= self.capacity:
+            family = OTHER
+        self.pending[family] = self.pending.get(family, 0) + hits
+
+    def merge(self, counts: Dict[str, int]) -> None:
+        for family, hits in counts.items():
+            self.count(family, hits)
+
+    def take(self) -> Dict[str, int]:
+        pending, self.pending = self.pending, {}
+        return pending
@@ -1,16 +1,16 @@
 from core.orm import *
 from aiohttp import web
 from core.config import Config
-import toml
+from core.version import VERSION
 import os
 import platform
-import psutil
 
-API_VERSION = Config.get("advanced.api_version")
-VERSION = toml.loads(open("pyproject.toml", "r").read())["tool"]["poetry"]["version"]
+API_VERSION = Config.settings.advanced.api_version
 
 
 async def getStatus(cluster) -> web.Response:
+    import psutil
+
     hourly_hits = getHourlyHits()
     daily_hits = getDailyHits()
     monthly_hits = getMonthlyHits()
@@ -29,7 +29,8 @@ async def getStatus(cluster) -> web.Response:
             "months": monthly_hits["prevStats"],
         },
         "accesses": agent_info,
-        "connections": cluster.router.connection if cluster.router else 0,
+        "connections": (cluster.router.connection if cluster.router else 0)
+        + (cluster.workers.connections() if cluster.workers else 0),
         "memory": psutil.Process(os.getpid()).memory_info().rss,
         "cpu": psutil.Process(os.getpid()).cpu_percent(),
         "pythonVersion": platform.python_version(),
@@ -56,4 +56,20 @@ class Storage(ABC):
 
     @abstractmethod
     async def recycleFiles(self, files: FileList) -> None:
-        pass
\ No newline at end of file
+        pass
+
+    async def readFile(self, hash: str) -> Union[bytes, None]:
+        return None
+
+    def mapFile(self, hash: str) -> Union[memoryview, None]:
+        """
+        Blocking, the contents of a file held locally, or None.
+        """
+        return None
+
+    async def quarantineFile(self, hash: str) -> bool:
+        """
+        Take a corrupt file out of service. Returns whether it has to be
+        downloaded again.
+        """
+        return False
\ No newline at end of file
@@ -1,41 +1,56 @@
 """
 todo:
 1. 缺失文件时临时下载文件处理
-2. 断连时重新发送 disable 包
 """
 
 from core.config import Config
 from core.logger import logger
 from core.scheduler import *
 from core.exceptions import ClusterIdNotSetError, ClusterSecretNotSetError
-from core.storages import getStorages, LocalStorage, AListStorage
-from core.classes import FileInfo, FileList, AgentConfiguration
-from core.router import Router
-from core.orm import writeHits
+from core.storages import (
+    getStorages,
+    LocalStorage,
+    AListStorage,
+    TieredStorage,
+    PackStorage,
+)
+from core.classes import FileInfo, FileList, AgentConfiguration, Storage
+from core.router import Router, AccessLogger
+from core.performance import runnerOptions, siteOptions, inheritedSocket
+from core.tls import CertificateReloader
+from core.scrubber import Scrubber
+from core.coordination import Coordinator
+from core.planner import SyncPlan
+from core.orm import writeHits, getHotFiles, submit
 from core.i18n import locale
+from core.version import VERSION
+from core import metrics
 from typing import List, Any, Union
+from enum import Enum
 from aiohttp import web, ClientResponseError
 from urllib.parse import urljoin
 from tqdm import tqdm
-from pathlib import Path
-import toml
 import aiofiles
-import socketio
-import zstandard as zstd
 import aiohttp
 import asyncio
 import hmac
 import datetime
 import hashlib
-import ssl
 import sys
 import os
 import humanize
 import io
+import random
 import time
 
-API_VERSION = Config.get("advanced.api_version")
-VERSION = toml.loads(open("pyproject.toml", "r").read())["tool"]["poetry"]["version"]
+API_VERSION = Config.settings.advanced.api_version
+
+
+class SocketState(Enum):
+    DISCONNECTED = "disconnected"
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+    CLOSED = "closed"
 
 
 class Token:
@@ -43,10 +58,10 @@ class Token:
         self.user_agent = (
             f"openbmclapi-cluster/{API_VERSION} python-openbmclapi/{VERSION}"
         )
-        self.base_url = Config.get("cluster.base_url")
+        self.base_url = Config.settings.cluster.base_url
         self.token = None
-        self.id = Config.get("cluster.id")
-        self.secret = Config.get("cluster.secret")
+        self.id = Config.settings.cluster.id
+        self.secret = Config.settings.cluster.secret
         self.ttl = 0
         self.scheduler = None
 
@@ -88,27 +103,45 @@ class Token:
 
 
 class Cluster:
-    def __init__(self) -> None:
+    def __init__(self, primary: str | None = None) -> None:
         self.user_agent = (
             f"openbmclapi-cluster/{API_VERSION} python-openbmclapi/{VERSION}"
         )
-        self.base_url = Config.get("cluster.base_url")
+        self.base_url = Config.settings.cluster.base_url
         self.last_modified = 1000
-        self.id = Config.get("cluster.id")
-        self.secret = Config.get("cluster.secret")
+        self.id = Config.settings.cluster.id
+        self.secret = Config.settings.cluster.secret
         self.token = Token()
         self.filelist = FileList(files=[])
-        self.storages = getStorages()
+        # The compressed file list as received, published to followers.
+        self.filelist_data = b""
+        # In a worker process, the primary's socket for the endpoints that
+        # only the primary answers.
+        self.primary = primary
+        self.storages = getStorages(readonly=primary is not None)
         self.configuration = None
         self.semaphore = asyncio.Semaphore()
-        self.socket = socketio.AsyncClient(handle_sigint=False)
+        self.socket = None
+        self.state = SocketState.DISCONNECTED
+        self.reconnecting: asyncio.Task | None = None
+        # When the connection was lost, for the time-to-re-enable metric.
+        self.disconnected_at: float | None = None
         self.router: Router | None = None
         self.runner = None
+        self.workers = None
+        self.internal = None
         self.failed_filelist = FileList(files=[])
+        self.scrubber = Scrubber(self)
+        self.coordinator = Coordinator(self)
+        self.plan: SyncPlan | None = None
+        # Hits and bytes counted but not yet acknowledged by a keep-alive.
+        self.unreported = {"hits": 0, "bytes": 0}
+        self.reporting = asyncio.Lock()
         self.enabled = False
         self.site = None
+        self.tls = None
         self.want_enable = False
-        self.scheduler = scheduler
+        self.scheduler = None
         self.start_time = int(time.time() * 1000)
 
     async def fetchFileList(self) -> None:
@@ -125,27 +158,33 @@ class Cluster:
             )
             response.raise_for_status()
             logger.tsuccess("cluster.success.filelist.fetched")
+            self.filelist_data = await response.read()
+        self.loadFileList(self.filelist_data)
 
-            decompressed_data = io.BytesIO(
-                zstd.ZstdDecompressor()
-                .stream_reader(io.BytesIO(await response.read()))
-                .read()
-            )
-            self.filelist.files = [
-                FileInfo(
-                    self.readString(decompressed_data),
-                    self.readString(decompressed_data),
-                    self.readLong(decompressed_data),
-                    self.readLong(decompressed_data),
-                )
-                for _ in range(self.readLong(decompressed_data))
-            ]
-            size = sum(file.size for file in self.filelist.files)
-            logger.tsuccess(
-                "cluster.success.filelist.parsed",
-                count=humanize.intcomma(len(self.filelist.files)),
-                size=humanize.naturalsize(size, binary=True),
+    def loadFileList(self, data: bytes) -> None:
+        import zstandard as zstd
+
+        start = time.perf_counter()
+        decompressed_data = io.BytesIO(
+            zstd.ZstdDecompressor().stream_reader(io.BytesIO(data)).read()
+        )
+        self.filelist.files = [
+            FileInfo(
+                self.readString(decompressed_data),
+                self.readString(decompressed_data),
+                self.readLong(decompressed_data),
+                self.readLong(decompressed_data),
             )
+            for _ in range(self.readLong(decompressed_data))
+        ]
+        metrics.filelist_parse_duration.set(time.perf_counter() - start)
+        metrics.filelist_files.set(len(self.filelist.files))
+        size = sum(file.size for file in self.filelist.files)
+        logger.tsuccess(
+            "cluster.success.filelist.parsed",
+            count=humanize.intcomma(len(self.filelist.files)),
+            size=humanize.naturalsize(size, binary=True),
+        )
 
     async def getConfiguration(self) -> None:
         async with aiohttp.ClientSession(
@@ -186,8 +225,22 @@ class Cluster:
             )
             return missing_filelist
 
+    def planSync(self, missing_filelist: FileList) -> SyncPlan:
+        hits = {hash: count - error for hash, count, error, _ in getHotFiles()}
+        self.plan = SyncPlan(
+            self.filelist,
+            missing_filelist,
+            hits,
+            Config.settings.advanced.enable_coverage,
+        )
+        return self.plan
+
     async def syncFiles(
-        self, missing_filelist: FileList, retry: int, delay: int
+        self,
+        missing_filelist: FileList,
+        retry: int,
+        delay: int,
+        storages: List[Storage] | None = None,
     ) -> None:
         if not missing_filelist.files:
             logger.tinfo("cluster.info.sync_files.skipped")
@@ -205,8 +258,11 @@ class Cluster:
                 self.base_url, headers={"User-Agent": self.user_agent}
             ) as session:
                 self.failed_filelist = FileList(files=[])
+                metrics.sync_queue_depth.set(len(missing_filelist.files))
                 tasks = [
-                    asyncio.create_task(self.downloadFile(file, session, pbar))
+                    asyncio.create_task(
+                        self.downloadFile(file, session, pbar, storages)
+                    )
                     for file in missing_filelist.files
                 ]
                 await asyncio.gather(*tasks)
@@ -216,7 +272,7 @@ class Cluster:
             elif retry > 1:
                 logger.terror("cluster.error.sync_files.retry", retry=delay)
                 await asyncio.sleep(delay)
-                await self.syncFiles(self.failed_filelist, retry - 1, delay)
+                await self.syncFiles(self.failed_filelist, retry - 1, delay, storages)
             else:
                 logger.terror("cluster.error.sync_files.failed")
 
@@ -225,10 +281,15 @@ class Cluster:
             await storage.recycleFiles(self.filelist)
 
     async def downloadFile(
-        self, file: FileInfo, session: aiohttp.ClientSession, pbar: tqdm
+        self,
+        file: FileInfo,
+        session: aiohttp.ClientSession,
+        pbar: tqdm,
+        storages: List[Storage] | None = None,
     ) -> None:
         async with self.semaphore:
-            delay, retry = Config.get("advanced.delay"), Config.get("advanced.retry")
+            settings = Config.settings.advanced
+            delay, retry = settings.delay, settings.retry
 
             for _ in range(retry):
                 try:
@@ -237,14 +298,17 @@ class Cluster:
                         response.raise_for_status()
                         results = await asyncio.gather(
                             *(
-                                storage.writeFile(
-                                    file, io.BytesIO(content), delay, retry
-                                )
-                                for storage in self.storages
+                                self.writeFile(storage, file, content, delay, retry)
+                                for storage in storages or self.storages
                             )
                         )
                         if all(results):
                             pbar.update(len(content))
+                            metrics.sync_queue_depth.dec()
+                            metrics.sync_files.labels("success").inc()
+                            metrics.sync_bytes.inc(len(content))
+                            if self.plan:
+                                self.plan.done(file)
                             return
 
                 except ClientResponseError as e:
@@ -267,8 +331,54 @@ class Cluster:
                 await asyncio.sleep(delay)
 
             logger.terror("cluster.error.download_file.failed", file=file.hash)
+            metrics.sync_queue_depth.dec()
+            metrics.sync_files.labels("failed").inc()
             self.failed_filelist.files.append(file)
 
+    async def restoreFile(self, file: FileInfo, storage: Storage) -> bool:
+        """
+        Downloads a single file into one storage again, e.g. after it was
+        found corrupt. Unlike syncFiles it leaves the state of the current
+        synchronisation alone.
+        """
+        settings = Config.settings.advanced
+        delay, retry = settings.delay, settings.retry
+        async with aiohttp.ClientSession(
+            self.base_url, headers={"User-Agent": self.user_agent}
+        ) as session:
+            for _ in range(retry):
+                try:
+                    async with self.semaphore:
+                        async with session.get(file.path) as response:
+                            content = await response.read()
+                            response.raise_for_status()
+                    if await self.writeFile(storage, file, content, delay, retry):
+                        return True
+                except ClientResponseError as e:
+                    logger.terror(
+                        "cluster.error.download_file.retry",
+                        file=file.hash,
+                        e=e.message,
+                        retry=delay,
+                    )
+                    await self.report(e, session)
+                except Exception as e:
+                    logger.terror(
+                        "cluster.error.download_file.retry",
+                        file=file.hash,
+                        e=e,
+                        retry=delay,
+                    )
+                await asyncio.sleep(delay)
+        logger.terror("cluster.error.download_file.failed", file=file.hash)
+        return False
+
+    async def writeFile(
+        self, storage: Storage, file: FileInfo, content: bytes, delay: int, retry: int
+    ) -> bool:
+        with metrics.storage_write_duration.labels(type(storage).__name__).time():
+            return await storage.writeFile(file, io.BytesIO(content), delay, retry)
+
     async def report(
         self, error: ClientResponseError, session: aiohttp.ClientSession
     ) -> None:
@@ -293,53 +403,99 @@ class Cluster:
         except Exception as e:
             logger.terror("cluster.error.router.exception", e=e)
 
-    async def listen(self, https: bool, port: int) -> None:
+    async def listen(self, https: bool, port: int, reuse_port: bool = False) -> None:
         try:
             ssl_context = None
             if https:
-                ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                ssl_context.load_cert_chain(
-                    certfile=Path(Config.get("advanced.paths.cert")),
-                    keyfile=Path(Config.get("advanced.paths.key")),
+                self.tls = CertificateReloader(
+                    Config.settings.advanced.paths.cert,
+                    Config.settings.advanced.paths.key,
                 )
-                ssl_context.check_hostname = False
+                self.tls.start()
+                ssl_context = self.tls.context
 
-            self.runner = web.AppRunner(self.application)
-            await self.runner.setup()
-            self.site = web.TCPSite(
-                self.runner, "0.0.0.0", port, ssl_context=ssl_context
+            self.runner = web.AppRunner(
+                self.application, access_log_class=AccessLogger, **runnerOptions()
             )
+            await self.runner.setup()
+            sock = inheritedSocket()
+            if sock:
+                self.site = web.SockSite(
+                    self.runner, sock, ssl_context=ssl_context, **siteOptions()
+                )
+                port = sock.getsockname()[1]
+            else:
+                self.site = web.TCPSite(
+                    self.runner,
+                    "0.0.0.0",
+                    port,
+                    ssl_context=ssl_context,
+                    reuse_port=reuse_port or None,
+                    **siteOptions(),
+                )
             await self.site.start()
+            if self.workers:
+                self.internal = web.UnixSite(self.runner, self.workers.path)
+                await self.internal.start()
+                os.chmod(self.workers.path, 0o600)
             logger.tsuccess("cluster.success.listen", port=port)
         except Exception as e:
             logger.terror("cluster.error.listen", e=e)
 
+    async def drain(self) -> None:
+        if self.site:
+            await self.site.stop()
+            self.site = None
+        if self.runner:
+            if self.router and self.router.connection:
+                logger.tinfo("cluster.info.draining", count=self.router.connection)
+            await self.runner.cleanup()
+            self.runner = None
+
+    def swapCounters(self) -> None:
+        """
+        Closes the current counting epoch and adds it to the unreported
+        totals. The router counts into a fresh dict from here on, so nothing
+        counted while a keep-alive is in flight can be lost or sent twice.
+        """
+        assert self.router is not None
+        epoch, self.router.counters = self.router.counters, {"hits": 0, "bytes": 0}
+        if self.workers:
+            hits, bytes = self.workers.collect()
+            epoch["hits"] += hits
+            epoch["bytes"] += bytes
+        self.unreported["hits"] += epoch["hits"]
+        self.unreported["bytes"] += epoch["bytes"]
+
+    def flushHits(self) -> None:
+        if not self.router:
+            return
+        self.swapCounters()
+        writeHits(self.unreported["hits"], self.unreported["bytes"])
+        self.unreported = {"hits": 0, "bytes": 0}
+
     async def enable(self) -> None:
         if self.enabled:
             return
 
         logger.tinfo("cluster.info.enabling")
-        future = asyncio.Future()
-
-        async def callback(data: List[Any]):
-            future.set_result(data)
 
         if not self.socket:
             logger.terror("cluster.error.disconnected")
             return
 
         try:
-            await self.socket.emit(
+            response = await self.call(
                 "enable",
-                data={
-                    "host": Config.get("cluster.host"),
+                {
+                    "host": Config.settings.cluster.host,
                     "port": (
-                        Config.get("cluster.public_port")
-                        if Config.get("cluster.public_port") != -1
-                        else Config.get("cluster.port")
+                        Config.settings.cluster.public_port
+                        if Config.settings.cluster.public_port != -1
+                        else Config.settings.cluster.port
                     ),
                     "version": API_VERSION,
-                    "byoc": Config.get("cluster.byoc"),
+                    "byoc": Config.settings.cluster.byoc,
                     "noFastEnable": True,
                     "flavor": {
                         "runtime": f"python/{sys.version.split()[0]} python-openbmclapi/{VERSION}",
@@ -347,22 +503,26 @@ class Cluster:
                             [
                                 (
                                     "file"
-                                    if isinstance(storage, LocalStorage)
+                                    if isinstance(storage, (LocalStorage, PackStorage))
                                     else (
                                         "webdav"
                                         if isinstance(storage, AListStorage)
                                         else ""
                                     )
                                 )
-                                for storage in self.storages
+                                for storage in (
+                                    (
+                                        storage.origin
+                                        if isinstance(storage, TieredStorage)
+                                        else storage
+                                    )
+                                    for storage in self.storages
+                                )
                             ]
                         ),
                     },
                 },
-                callback=callback,
             )
-
-            response = await future
             error, ack = (
                 (response + [None, None])[:2]
                 if isinstance(response, list)
@@ -377,17 +537,24 @@ class Cluster:
                 return
 
             self.enabled = True
-            if not Config.get("cluster.byoc"):
+            if self.workers:
+                self.workers.setEnabled(True)
+            if self.disconnected_at is not None:
+                metrics.socket_reenable_duration.observe(
+                    time.monotonic() - self.disconnected_at
+                )
+                self.disconnected_at = None
+            if not Config.settings.cluster.byoc:
                 logger.tsuccess(
                     "cluster.success.enable.enabled",
                     id=self.id,
-                    port=Config.get("cluster.public_port"),
+                    port=Config.settings.cluster.public_port,
                 )
             else:
                 logger.tsuccess(
                     "cluster.success.enable.enabled.byoc",
-                    host=Config.get("cluster.host"),
-                    port=Config.get("cluster.public_port"),
+                    host=Config.settings.cluster.host,
+                    port=Config.settings.cluster.public_port,
                 )
         except Exception as e:
             logger.terror("cluster.error.enable.exception", e=e)
@@ -405,21 +572,22 @@ class Cluster:
             logger.terror("cluster.error.keep_alive.router_not_setup")
             return False
 
-        future = asyncio.Future()
+        # One report at a time, so an overlapping keep-alive can't resend
+        # what the one in flight is reporting.
+        async with self.reporting:
+            return await self.reportCounters()
 
-        async def callback(data: List[Any]):
-            future.set_result(data)
-
-        counter = self.router.counters
+    async def reportCounters(self) -> bool:
+        assert self.router is not None
+        self.swapCounters()
+        # Totals that aren't acknowledged stay unreported for the next try.
+        counter = dict(self.unreported)
 
         try:
-            await self.socket.emit(
+            response = await self.call(
                 "keep-alive",
-                data={"time": datetime.datetime.now().isoformat(), **counter},
-                callback=callback,
+                {"time": datetime.datetime.now().isoformat(), **counter},
             )
-
-            response = await future
             error, date = (
                 (response + [None, None])[:2]
                 if isinstance(response, list)
@@ -430,18 +598,18 @@ class Cluster:
                 logger.terror("cluster.error.keep_alive.error", e=error)
                 return False
 
+            self.unreported["hits"] -= counter["hits"]
+            self.unreported["bytes"] -= counter["bytes"]
             logger.tsuccess(
                 "cluster.success.keep_alive.success",
                 hits=humanize.intcomma(counter["hits"]),
                 size=humanize.naturalsize(counter["bytes"], binary=True),
             )
-            writeHits(self.router.counters["hits"], self.router.counters["bytes"])
-            self.router.counters["bytes"] -= counter["bytes"]
-            self.router.counters["hits"] -= counter["hits"]
+            await submit(writeHits, counter["hits"], counter["bytes"])
             if not self.scheduler:
                 self.scheduler = scheduler.add_job(
                     self.keepAlive,
-                    IntervalTrigger(seconds=Config.get("advanced.keep_alive")),
+                    IntervalTrigger(seconds=Config.settings.advanced.keep_alive),
                     max_instances=50,
                 )
 
@@ -456,16 +624,15 @@ class Cluster:
             return
 
         self.enabled = False
+        if self.workers:
+            self.workers.setEnabled(False)
+        if not self.socket.connected:
+            # Nothing to tell, central drops the node with the connection.
+            return
         logger.tinfo("cluster.info.disabling")
-        future = asyncio.Future()
-
-        async def callback(data: List[Any]):
-            future.set_result(data)
 
         try:
-            await self.socket.emit("disable", callback=callback)
-
-            response = await future
+            response = await self.call("disable")
             error, ack = (
                 (response + [None, None])[:2]
                 if isinstance(response, list)
@@ -482,46 +649,100 @@ class Cluster:
         except Exception as e:
             logger.terror("cluster.error.disable.exception", e=e)
 
-    async def connect(self) -> None:
-        if self.socket and self.socket.connected:
-            return
-        async def onConnect() -> None:
-            logger.tsuccess("client.success.connected")
-            await self.disable()
-            if self.want_enable:
-                await self.enable()
-            if self.scheduler:
-                self.scheduler.resume()
-        async def onDisconnect() -> None:
-            logger.twarning("client.warn.disconnected")
-            if self.scheduler:
-                self.scheduler.pause()
-        async def onMessage(message: str) -> None:
-            logger.tinfo("client.info.message", message=message)
-        self.socket.on("connect", onConnect)
-        self.socket.on("disconnect", onDisconnect)
-        self.socket.on("message", onMessage)
-        await self.socket.connect(
-            self.base_url,
-            transports=["websocket"],
-            auth={"token": str(self.token.token)},
+    async def call(self, event: str, data: Any = None) -> Any:
+        # A lost acknowledgement raises instead of waiting forever.
+        assert self.socket is not None
+        return await self.socket.call(
+            event, data, timeout=Config.settings.advanced.socket.ack_timeout
         )
 
+    async def connect(self) -> None:
+        if self.socket is None:
+            import socketio
+
+            # Reconnection is driven by reconnect() instead of the client.
+            self.socket = socketio.AsyncClient(
+                handle_sigint=False, reconnection=False
+            )
+
+            async def onConnect() -> None:
+                self.state = SocketState.CONNECTED
+                logger.tsuccess("client.success.connected")
+                # Central may still count us as enabled from the last session.
+                await self.disable()
+                if self.want_enable:
+                    await self.enable()
+                if self.scheduler:
+                    self.scheduler.resume()
+
+            async def onDisconnect(*_: Any) -> None:
+                if self.state == SocketState.CLOSED:
+                    return
+                logger.twarning("client.warn.disconnected")
+                self.state = SocketState.DISCONNECTED
+                if self.disconnected_at is None:
+                    self.disconnected_at = time.monotonic()
+                if self.scheduler:
+                    self.scheduler.pause()
+                if not self.reconnecting or self.reconnecting.done():
+                    self.reconnecting = asyncio.create_task(self.reconnect())
+
+            async def onMessage(message: str) -> None:
+                logger.tinfo("client.info.message", message=message)
+
+            self.socket.on("connect", onConnect)
+            self.socket.on("disconnect", onDisconnect)
+            self.socket.on("message", onMessage)
+        if self.state in (SocketState.DISCONNECTED, SocketState.CLOSED):
+            await self.reconnect(refresh=False)
+
+    async def reconnect(self, refresh: bool = True) -> None:
+        """
+        Connects with jittered exponential backoff until it succeeds. The token
+        is fetched again before every retry, since an expired or revoked token
+        is a common reason for being refused.
+        """
+        assert self.socket is not None
+        settings = Config.settings.advanced.socket
+        attempt = 0
+        while self.state != SocketState.CLOSED and not self.socket.connected:
+            if attempt:
+                delay = min(settings.backoff_max, settings.backoff_base * 2**attempt)
+                await asyncio.sleep(random.uniform(delay / 2, delay))
+            attempt += 1
+            self.state = SocketState.CONNECTING
+            metrics.socket_connects.inc()
+            try:
+                if refresh:
+                    await self.token.fetchToken()
+                await self.socket.connect(
+                    self.base_url,
+                    transports=["websocket"],
+                    auth={"token": str(self.token.token)},
+                    wait_timeout=settings.ack_timeout,
+                )
+            except Exception as e:
+                self.state = SocketState.DISCONNECTED
+                logger.terror("client.error.reconnect", e=e)
+                refresh = True
+
+    async def close(self) -> None:
+        self.state = SocketState.CLOSED
+        if self.reconnecting:
+            self.reconnecting.cancel()
+        if self.socket:
+            await self.socket.disconnect()
+
     async def requestCertificate(self) -> None:
-        cert_path, key_path = Config.get("advanced.paths.cert"), Config.get(
-            "advanced.paths.key"
+        cert_path, key_path = (
+            Config.settings.advanced.paths.cert,
+            Config.settings.advanced.paths.key,
         )
         os.makedirs(os.path.dirname(cert_path), exist_ok=True)
         os.makedirs(os.path.dirname(key_path), exist_ok=True)
 
-        future = asyncio.Future()
-
-        async def callback(data: List[Any]):
-            future.set_result(data)
-
         try:
-            await self.socket.emit("request-cert", callback=callback)
-            error, cert = await future
+            error, cert = await self.call("request-cert")
             if error:
                 raise Exception(error)
 
@@ -531,6 +752,8 @@ class Cluster:
                 await f.write(cert["key"])
 
             logger.tsuccess("client.success.request_certificate")
+            if self.tls:
+                self.tls.reload()
         except Exception as e:
             logger.terror("client.error.request_certificate", e=e)
 
@@ -1,5 +1,8 @@
+from core.exceptions import ConfigValueError
 from pathlib import Path
-from typing import Any
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Tuple
+import keyword
 import yaml
 import os
 
@@ -10,7 +13,59 @@ defaults = {
     "advanced.retry": 5,
     "advanced.delay": 15,
     "advanced.keep_alive": 60,
+    "advanced.socket.ack_timeout": 30,
+    "advanced.socket.backoff_base": 1,
+    "advanced.socket.backoff_max": 60,
     "advanced.sync_interval": 120,
+    "advanced.enable_coverage": 1.0,
+    "advanced.hot_files.capacity": 1024,
+    "advanced.hot_files.persist_interval": 300,
+    "advanced.agents.capacity": 256,
+    "advanced.agents.flush_interval": 60,
+    "advanced.profiler.block_threshold": 0.5,
+    "advanced.profiler.task_timing": False,
+    "advanced.admin.token": "",
+    "advanced.workers": 0,
+    "advanced.logging.enqueue": True,
+    "advanced.logging.access_sample": 0.0,
+    "advanced.drain_timeout": 30,
+    "advanced.performance.uvloop": False,
+    "advanced.performance.backlog": 128,
+    "advanced.performance.keepalive_timeout": 75,
+    "advanced.performance.handler_cancellation": False,
+    "advanced.performance.access_log": True,
+    "advanced.ratelimit.global": 0,
+    "advanced.ratelimit.per_client": 0,
+    "advanced.ratelimit.burst": 1.0,
+    "advanced.admission.max_transfers": 0,
+    "advanced.admission.queue": 64,
+    "advanced.admission.queue_timeout": 2.0,
+    "advanced.admission.retry_after": 5,
+    "advanced.measure.sendfile": False,
+    "advanced.measure.sizes": [1, 10],
+    "advanced.measure.url_ttl": 600,
+    "advanced.tls.reload_interval": 60,
+    "advanced.tls.session_tickets": 2,
+    "advanced.tls.ciphers": "ECDHE+AESGCM:ECDHE+CHACHA20",
+    "advanced.tiered.promote_after": 2,
+    "advanced.tiered.promote_concurrency": 4,
+    "advanced.tiered.candidates": 8192,
+    "advanced.pack.max_object": 1048576,
+    "advanced.pack.pack_size": 268435456,
+    "advanced.pack.flush_interval": 60,
+    "advanced.pack.compact_interval": 3600,
+    "advanced.pack.compact_ratio": 0.5,
+    "advanced.storage.fsync": True,
+    "advanced.storage.fsync_batch": 128,
+    "advanced.storage.fsync_delay": 0.02,
+    "advanced.scrub.rate": 8388608,
+    "advanced.scrub.cycle_interval": 604800,
+    "advanced.scrub.pause_connections": 16,
+    "advanced.signature.cache_size": 4096,
+    "advanced.coordination.database": "",
+    "advanced.coordination.node": "",
+    "advanced.coordination.lease": 60,
+    "advanced.coordination.poll_interval": 10,
     "cluster.base_url": "https://openbmclapi.bangbang93.com",
     "cluster.id": "",
     "cluster.secret": "",
@@ -21,32 +76,156 @@ defaults = {
     "storages": [{"type": "local", "path": "./cache"}],
     "advanced.paths.cert": "./cert/cert.pem",
     "advanced.paths.key": "./cert/key.pem",
+    "advanced.paths.measure": "./measure/measure.bin",
 }
 
+# Tunables that take effect without a restart when the configuration is
+# reloaded, everything else keeps its startup value until the next start.
+reloadable = (
+    "advanced.retry",
+    "advanced.delay",
+    "advanced.enable_coverage",
+    "advanced.socket.",
+    "advanced.admin.token",
+    "advanced.logging.access_sample",
+    "advanced.ratelimit.",
+    "advanced.admission.",
+    "advanced.measure.sendfile",
+    "advanced.measure.url_ttl",
+    "advanced.tiered.promote_after",
+    "advanced.pack.max_object",
+    "advanced.pack.pack_size",
+    "advanced.pack.compact_ratio",
+    "advanced.storage.",
+    "advanced.scrub.",
+    "advanced.coordination.lease",
+    "advanced.coordination.poll_interval",
+)
+
+
+class Section:
+    """
+    Read-only view of one level of the configuration, e.g.
+    `Config.settings.advanced.retry`. Keys that are Python keywords get a
+    trailing underscore (`advanced.ratelimit.global_`).
+    """
+
+    def __init__(self, values: Dict[str, Any]) -> None:
+        for name, value in values.items():
+            if keyword.iskeyword(name):
+                name += "_"
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"configuration is read-only, cannot set {name}")
+
+    def __repr__(self) -> str:
+        return f"Section({vars(self)})"
+
+
+def freeze(value: Any) -> Any:
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def coerce(key: str, value: Any, default: Any) -> Any:
+    if isinstance(value, str) and not isinstance(default, str):
+        # Environment overrides are always strings.
+        if isinstance(default, bool):
+            value = value.strip().lower() in ("1", "true", "yes", "on")
+        else:
+            value = yaml.safe_load(value)
+    if isinstance(default, bool):
+        valid = isinstance(value, bool)
+    elif isinstance(default, (int, float)):
+        valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+        if valid and isinstance(default, float):
+            value = float(value)
+    elif isinstance(default, str):
+        valid = isinstance(value, (str, int, float)) and not isinstance(value, bool)
+        value = str(value)
+    else:
+        valid = isinstance(value, type(default))
+    if not valid:
+        raise ConfigValueError(
+            f"{key} should be {type(default).__name__}, got {value!r}"
+        )
+    return freeze(value)
+
 
 class CFG:
     def __init__(self, path: str) -> None:
         self.file = Path(path)
         self.cfg = {}
+        self.listeners: List[Callable[[Section], None]] = []
         if self.file.exists():
             self.load()
-        else:
-            for key, value in defaults.items():
-                self.set(key, value)
+        # Missing keys are filled in while resolving and written back in one
+        # go, so the file lists every setting.
+        self.filled = False
+        self.values = self.resolve()
+        if self.filled:
+            self.save()
+        self.settings = self.build(self.values)
 
     def load(self) -> None:
         with open(self.file, "r", encoding="utf-8") as f:
             self.cfg = yaml.load(f.read(), Loader=yaml.FullLoader) or {}
 
-    def get(self, key: str, def_: Any = None) -> Any:
-        value = os.environ.get(key, None) or self._getValue(self.cfg, key.split("."))
-        if value is None and def_ is None:
-            print(f"[Config] {key} is not set, does it exist?")
-            if key in defaults:
-                value = defaults.get(key, None)
-                if value is not None:
-                    self.set(key, value)
-        return value
+    def resolve(self) -> Dict[str, Any]:
+        values = {}
+        for key, default in defaults.items():
+            stored = self._getValue(self.cfg, key.split("."))
+            if stored is None:
+                self._setValue(self.cfg, key.split("."), default)
+                self.filled = True
+            value = os.environ.get(key, None)
+            if value is None:
+                value = stored
+            values[key] = default if value is None else coerce(key, value, default)
+        return values
+
+    def build(self, values: Dict[str, Any], prefix: str = "") -> Section:
+        names: Dict[str, Any] = {}
+        for key, value in values.items():
+            if not key.startswith(prefix):
+                continue
+            name, nested, _ = key[len(prefix) :].partition(".")
+            if nested:
+                if name not in names:
+                    names[name] = self.build(values, f"{prefix}{name}.")
+            else:
+                names[name] = value
+        return Section(names)
+
+    def reload(self) -> Tuple[List[str], List[str]]:
+        """
+        Re-read the file and swap in a new snapshot. Returns the keys that were
+        applied and the changed keys that need a restart.
+        """
+        self.load()
+        fresh = self.resolve()
+        applied, ignored = [], []
+        values = dict(self.values)
+        for key, value in fresh.items():
+            if value == values[key]:
+                continue
+            if key.startswith(reloadable):
+                values[key] = value
+                applied.append(key)
+            else:
+                ignored.append(key)
+        self.values = values
+        self.settings = self.build(values)
+        for listener in self.listeners:
+            listener(self.settings)
+        return applied, ignored
+
+    def onReload(self, listener: Callable[[Section], None]) -> None:
+        self.listeners.append(listener)
 
     def set(self, key: str, value: Any):
         self._setValue(self.cfg, key.split("."), value)
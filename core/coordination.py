@@ -0,0 +1,197 @@
+from core.config import Config
+from core.logger import logger
+from core import metrics
+from sqlalchemy import LargeBinary, create_engine, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Mapped, mapped_column, Session, DeclarativeBase
+from typing import TYPE_CHECKING, Union
+import asyncio
+import os
+import socket
+import time
+
+if TYPE_CHECKING:
+    from core.cluster import Cluster
+
+LEASE = "sync"
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class SyncLease(Base):
+    __tablename__ = "sync_lease"
+
+    name: Mapped[str] = mapped_column(primary_key=True)
+    node: Mapped[str]
+    expires: Mapped[float]
+
+
+class SyncIndex(Base):
+    __tablename__ = "sync_index"
+
+    name: Mapped[str] = mapped_column(primary_key=True)
+    node: Mapped[str]
+    published: Mapped[int]
+    data: Mapped[bytes] = mapped_column(LargeBinary)
+
+
+class Coordinator:
+    """
+    Lets several nodes that share one storage synchronise it only once.
+
+    With advanced.coordination.database pointing at an SQLite file every node
+    can reach, the nodes elect a leader through a lease row in it. The leader
+    renews the lease while it runs, fetches the file list, checks and fills
+    the storage as a single node would and then publishes the file list it
+    synchronised. Followers skip all of that: they load the published list
+    and keep serving. When the leader stops or its lease runs out, the next
+    follower to try takes over.
+    """
+
+    def __init__(self, cluster: "Cluster") -> None:
+        self.cluster = cluster
+        settings = Config.settings.advanced.coordination
+        self.node = settings.node or f"{socket.gethostname()}:{os.getpid()}"
+        self.engine = (
+            create_engine(
+                f"sqlite:///{settings.database}", connect_args={"timeout": 30}
+            )
+            if settings.database
+            else None
+        )
+        self.leader = False
+        # Publication time of the index this node last loaded.
+        self.published = 0
+        self.task: asyncio.Task | None = None
+        metrics.sync_leader.setFunction(lambda: int(self.leader))
+
+    @property
+    def enabled(self) -> bool:
+        return self.engine is not None
+
+    async def start(self) -> None:
+        if not self.enabled or self.task is not None:
+            return
+        await asyncio.to_thread(Base.metadata.create_all, self.engine)
+        await self.elect()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.leader:
+            self.leader = False
+            try:
+                await asyncio.to_thread(self.release)
+            except Exception as e:
+                logger.terror("coordination.error.failed", e=e)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(Config.settings.advanced.coordination.lease / 3)
+            await self.elect()
+
+    async def elect(self) -> bool:
+        try:
+            leader = await asyncio.to_thread(self.acquire)
+        except Exception as e:
+            logger.terror("coordination.error.failed", e=e)
+            # Without the database nobody can tell, stop acting as leader
+            # before another node may take over.
+            leader = False
+        if leader and not self.leader:
+            logger.tinfo("coordination.info.leader", node=self.node)
+        elif self.leader and not leader:
+            logger.twarning("coordination.warn.lost", node=self.node)
+        self.leader = leader
+        return leader
+
+    def acquire(self) -> bool:
+        now = time.time()
+        expires = now + Config.settings.advanced.coordination.lease
+        with Session(self.engine) as session:
+            session.execute(
+                insert(SyncLease)
+                .values(name=LEASE, node=self.node, expires=expires)
+                .on_conflict_do_nothing()
+            )
+            # A single UPDATE is atomic, only one node can win an expired lease.
+            result = session.execute(
+                update(SyncLease)
+                .where(
+                    SyncLease.name == LEASE,
+                    (SyncLease.node == self.node) | (SyncLease.expires < now),
+                )
+                .values(node=self.node, expires=expires)
+            )
+            session.commit()
+            return result.rowcount == 1
+
+    def release(self) -> None:
+        with Session(self.engine) as session:
+            session.execute(
+                update(SyncLease)
+                .where(SyncLease.name == LEASE, SyncLease.node == self.node)
+                .values(expires=0)
+            )
+            session.commit()
+
+    async def follow(self) -> bool:
+        """
+        Returns True if this node is a follower and has loaded the leader's
+        file list, False if it has to synchronise itself.
+        """
+        if not self.enabled:
+            return False
+        waiting = False
+        while not await self.elect():
+            try:
+                index = await asyncio.to_thread(self.read)
+            except Exception as e:
+                logger.terror("coordination.error.failed", e=e)
+                index = None
+            if index is not None:
+                if index.published != self.published:
+                    self.cluster.loadFileList(index.data)
+                    self.published = index.published
+                    logger.tsuccess(
+                        "coordination.success.loaded",
+                        node=index.node,
+                        count=len(self.cluster.filelist.files),
+                    )
+                return True
+            # The leader has not finished its first synchronisation yet.
+            if not waiting:
+                logger.tinfo("coordination.info.waiting")
+                waiting = True
+            await asyncio.sleep(Config.settings.advanced.coordination.poll_interval)
+        return False
+
+    def read(self) -> Union[SyncIndex, None]:
+        with Session(self.engine, expire_on_commit=False) as session:
+            return session.get(SyncIndex, LEASE)
+
+    async def publish(self) -> None:
+        if not self.enabled or not self.leader or not self.cluster.filelist_data:
+            return
+        index = SyncIndex(
+            name=LEASE,
+            node=self.node,
+            published=int(time.time() * 1000),
+            data=self.cluster.filelist_data,
+        )
+        try:
+            await asyncio.to_thread(self.write, index)
+        except Exception as e:
+            logger.terror("coordination.error.failed", e=e)
+            return
+        self.published = index.published
+        logger.tsuccess("coordination.success.published")
+
+    def write(self, index: SyncIndex) -> None:
+        with Session(self.engine) as session:
+            session.merge(index)
+            session.commit()
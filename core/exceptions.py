@@ -4,3 +4,7 @@ class ClusterIdNotSetError(Exception):
 
 class ClusterSecretNotSetError(Exception):
     pass
+
+
+class ConfigValueError(Exception):
+    pass
@@ -8,6 +8,7 @@ class Locale:
     def __init__(self, lang: str):
         self.path = Path(f"./i18n/{lang}.json")
         self.data = {}
+        self.templates = {}
         self.load()
 
     def __getitem__(self, key: str):
@@ -21,6 +22,7 @@ class Locale:
             d = f.read()
             self.data = json.loads(d)
             f.close()
+        self.templates = {key: Template(value) for key, value in self.data.items()}
 
     def get_string(self, key: str, failed_prompt):
         n = self.data.get(key, None)
@@ -31,8 +33,10 @@ class Locale:
         return key
 
     def t(self, key: str, failed_prompt=True, *args, **kwargs):
-        localized = self.get_string(key, failed_prompt)
-        return Template(localized).safe_substitute(*args, **kwargs)
+        template = self.templates.get(key)
+        if template is None:
+            template = Template(self.get_string(key, failed_prompt))
+        return template.safe_substitute(*args, **kwargs)
 
 
-locale = Locale(Config.get("advanced.lang"))
+locale = Locale(Config.settings.advanced.lang)
@@ -6,10 +6,14 @@ import sys
 
 
 basic_logger_format = "<green>[{time:YYYY-MM-DD HH:mm:ss}]</green><level>[{level}]<yellow>[{name}:{function}:{line}]</yellow>: {message}</level>"
-debug_mode = Config.get("advanced.debug")
+debug_mode = Config.settings.advanced.debug
+# Sinks write from a background thread so the event loop never waits on I/O.
+enqueue = Config.settings.advanced.logging.enqueue
 
 
 def filter(record) -> bool:
+    if record["extra"].get("access"):
+        return False
     if record["name"] and "apscheduler" in record["name"]:
         record["extra"] = {"depth": 2}
     return True
@@ -18,22 +22,40 @@ def filter(record) -> bool:
 class LoggingLogger:
     def __init__(self) -> None:
         self.log = Logger.opt(depth=1)
+        # Messages of t* helpers are only translated if a sink wants them.
+        self.lazy = Logger.opt(depth=1, lazy=True)
         self.log.remove()
+        level = "DEBUG" if debug_mode else "INFO"
         self.log.add(
             sys.stdout,
             format=basic_logger_format,
-            level="DEBUG" if debug_mode else "INFO",
+            level=level,
             colorize=True,
             filter=filter,
+            enqueue=enqueue,
         )
         self.cur_handler = None
         self.log.add(
             Path("./logs/{time:YYYY-MM-DD}.log"),
             format=basic_logger_format,
+            level=level,
             retention="10 days",
             encoding="utf-8",
             filter=filter,
+            enqueue=enqueue,
         )
+        self.access = None
+        if Config.settings.advanced.logging.access_sample > 0:
+            Logger.add(
+                Path("./logs/access-{time:YYYY-MM-DD}.log"),
+                format="{message}",
+                level="INFO",
+                retention="10 days",
+                encoding="utf-8",
+                filter=lambda record: record["extra"].get("access", False),
+                enqueue=enqueue,
+            )
+            self.access = Logger.bind(access=True)
         self.info = self.log.info
         self.debug = self.log.debug
         self.warning = self.log.warning
@@ -42,19 +64,19 @@ class LoggingLogger:
         self.add = self.log.add
 
     def tinfo(self, key: str, *args, **kwargs):
-        self.info(locale.t(key=key, *args, **kwargs))
+        self.lazy.info("{}", lambda: locale.t(key=key, *args, **kwargs))
 
     def tdebug(self, key: str, *args, **kwargs):
-        self.debug(locale.t(key=key, *args, **kwargs))
+        self.lazy.debug("{}", lambda: locale.t(key=key, *args, **kwargs))
 
     def twarning(self, key: str, *args, **kwargs):
-        self.warning(locale.t(key=key, *args, **kwargs))
+        self.lazy.warning("{}", lambda: locale.t(key=key, *args, **kwargs))
 
     def terror(self, key: str, *args, **kwargs):
-        self.error(locale.t(key=key, *args, **kwargs))
+        self.lazy.error("{}", lambda: locale.t(key=key, *args, **kwargs))
 
     def tsuccess(self, key: str, *args, **kwargs):
-        self.success(locale.t(key=key, *args, **kwargs))
+        self.lazy.success("{}", lambda: locale.t(key=key, *args, **kwargs))
 
 
 logger = LoggingLogger()
@@ -0,0 +1,46 @@
+from core.config import Config
+from core.ratelimit import FileSliceResponse
+from typing import AsyncIterator
+import asyncio
+import os
+
+MIB = 1024 * 1024
+MAX_SIZE = 200
+
+# Shared by every measure response and upload, never copied.
+MEASURE_CHUNK = memoryview(b"\x00\x66\xcc\xff" * 256 * 1024)
+
+
+async def measureChunks(size: int) -> AsyncIterator[memoryview]:
+    for _ in range(size):
+        yield MEASURE_CHUNK
+
+
+class MeasureFile:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.size = os.path.getsize(path) // MIB if os.path.exists(path) else 0
+        self.lock = asyncio.Lock()
+
+    async def ensure(self, size: int) -> None:
+        if size <= self.size:
+            return
+        async with self.lock:
+            if size > self.size:
+                await asyncio.to_thread(self.grow, size)
+
+    def grow(self, size: int) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "r+b" if os.path.exists(self.path) else "wb") as f:
+            f.truncate(self.size * MIB)
+            f.seek(self.size * MIB)
+            for _ in range(self.size, size):
+                f.write(MEASURE_CHUNK)
+        self.size = size
+
+    async def response(self, size: int) -> FileSliceResponse:
+        await self.ensure(size)
+        return FileSliceResponse(self.path, 0, size * MIB)
+
+
+measure_file = MeasureFile(Config.settings.advanced.paths.measure)
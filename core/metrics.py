@@ -0,0 +1,437 @@
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+from bisect import bisect_left
+import asyncio
+import time
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def formatLabels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    labels = [f'{name}="{escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def formatValue(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labels: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.children: Dict[Tuple[str, ...], "Metric"] = {}
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.child()
+        return child
+
+    @abstractmethod
+    def child(self):
+        pass
+
+    @abstractmethod
+    def state(self, child) -> Any:
+        pass
+
+    @abstractmethod
+    def restore(self, state: Any):
+        pass
+
+    def export(self) -> List[Tuple[Tuple[str, ...], Any]]:
+        return [(values, self.state(child)) for values, child in self.children.items()]
+
+    def series(self, imported: Dict[str, Dict[str, list]]) -> List[Tuple]:
+        """
+        Own children, then those exported by other processes with an extra
+        `worker` label.
+        """
+        result = [
+            (self.label_names, values, child)
+            for values, child in list(self.children.items())
+        ]
+        names = self.label_names + ("worker",)
+        for worker, snapshot in imported.items():
+            for values, state in snapshot.get(self.name, ()):
+                result.append((names, (*values, worker), self.restore(state)))
+        return result
+
+    @abstractmethod
+    def samples(self, series: List[Tuple]) -> List[str]:
+        pass
+
+    def render(self, imported: Dict[str, Dict[str, list]]) -> str:
+        return "\n".join(
+            [
+                f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.type}",
+                *self.samples(self.series(imported)),
+            ]
+        )
+
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def child(self) -> CounterChild:
+        return CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def state(self, child: CounterChild) -> float:
+        return child.value
+
+    def restore(self, state: float) -> CounterChild:
+        child = CounterChild()
+        child.value = state
+        return child
+
+    def samples(self, series: List[Tuple]) -> List[str]:
+        return [
+            f"{self.name}{formatLabels(names, values)} {formatValue(child.value)}"
+            for names, values, child in series
+        ]
+
+
+class GaugeChild:
+    __slots__ = ("value", "function")
+
+    def __init__(self) -> None:
+        self.value = 0
+        self.function: Callable[[], float] | None = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def setFunction(self, function: Callable[[], float]) -> None:
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function else self.value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def child(self) -> GaugeChild:
+        return GaugeChild()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.labels().dec(amount)
+
+    def setFunction(self, function: Callable[[], float]) -> None:
+        self.labels().setFunction(function)
+
+    def state(self, child: GaugeChild) -> float:
+        return child.get()
+
+    def restore(self, state: float) -> GaugeChild:
+        child = GaugeChild()
+        child.value = state
+        return child
+
+    def samples(self, series: List[Tuple]) -> List[str]:
+        return [
+            f"{self.name}{formatLabels(names, values)} {formatValue(child.get())}"
+            for names, values, child in series
+        ]
+
+
+class HistogramChild:
+    __slots__ = ("bounds", "buckets", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> "Timer":
+        return Timer(self)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.bounds = tuple(sorted(buckets))
+
+    def child(self) -> HistogramChild:
+        return HistogramChild(self.bounds)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self) -> "Timer":
+        return self.labels().time()
+
+    def state(self, child: HistogramChild) -> Tuple[List[int], float, int]:
+        return list(child.buckets), child.sum, child.count
+
+    def restore(self, state: Tuple[List[int], float, int]) -> HistogramChild:
+        child = HistogramChild(self.bounds)
+        child.buckets, child.sum, child.count = state
+        return child
+
+    def samples(self, series: List[Tuple]) -> List[str]:
+        lines = []
+        for names, values, child in series:
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), child.buckets):
+                cumulative += count
+                le = f'le="{formatValue(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{formatLabels(names, values, le)} {cumulative}"
+                )
+            labels = formatLabels(names, values)
+            lines.append(f"{self.name}_sum{labels} {formatValue(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: HistogramChild) -> None:
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+        # Latest export of every worker process, by worker index.
+        self.imported: Dict[str, Dict[str, list]] = {}
+
+    def register(self, metric: Metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, documentation: str, labels: Sequence[str] = ()
+    ) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def export(self) -> Dict[str, list]:
+        return {name: metric.export() for name, metric in self.metrics.items()}
+
+    def render(self) -> str:
+        return (
+            "\n".join(metric.render(self.imported) for metric in self.metrics.values())
+            + "\n"
+        )
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "openbmclapi_http_requests_total",
+    "HTTP requests handled, by route and status code.",
+    ["route", "status"],
+)
+http_request_duration = registry.histogram(
+    "openbmclapi_http_request_duration_seconds",
+    "Time from request dispatch until the response has been sent.",
+    ["route"],
+)
+http_inflight = registry.gauge(
+    "openbmclapi_http_inflight_requests",
+    "Download requests currently being served.",
+)
+storage_express_duration = registry.histogram(
+    "openbmclapi_storage_express_duration_seconds",
+    "Time spent by a storage to produce a download response.",
+    ["storage"],
+)
+storage_bytes_served = registry.counter(
+    "openbmclapi_storage_served_bytes_total",
+    "Bytes served to clients, by storage.",
+    ["storage"],
+)
+storage_hits = registry.counter(
+    "openbmclapi_storage_hits_total",
+    "Successful hits, by storage.",
+    ["storage"],
+)
+storage_write_duration = registry.histogram(
+    "openbmclapi_storage_write_duration_seconds",
+    "Time spent by a storage to persist a synchronised file.",
+    ["storage"],
+)
+tiered_requests = registry.counter(
+    "openbmclapi_tiered_requests_total",
+    "Downloads handled by tiered storages, by cache result.",
+    ["result"],
+)
+tiered_promotions = registry.counter(
+    "openbmclapi_tiered_promotions_total",
+    "Files copied from the origin into the local cache, by result.",
+    ["result"],
+)
+tiered_cache_bytes = registry.gauge(
+    "openbmclapi_tiered_cache_bytes",
+    "Bytes held by the local cache of tiered storages.",
+)
+sync_queue_depth = registry.gauge(
+    "openbmclapi_sync_queue_depth",
+    "Files waiting to be downloaded by the current synchronisation.",
+)
+sync_files = registry.counter(
+    "openbmclapi_sync_files_total",
+    "Files processed by synchronisation, by result.",
+    ["result"],
+)
+sync_bytes = registry.counter(
+    "openbmclapi_sync_bytes_total",
+    "Bytes downloaded and written by synchronisation.",
+)
+sync_duration = registry.gauge(
+    "openbmclapi_sync_duration_seconds",
+    "Time spent downloading and writing the files of the last synchronisation.",
+)
+socket_connects = registry.counter(
+    "openbmclapi_socket_connects_total",
+    "Attempts to connect the socket.io session to the central server.",
+)
+socket_reenable_duration = registry.histogram(
+    "openbmclapi_socket_reenable_seconds",
+    "Time from losing the central connection until the node was enabled again.",
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0),
+)
+sync_leader = registry.gauge(
+    "openbmclapi_sync_leader",
+    "1 if this node holds the shared synchronisation lease.",
+)
+scrub_files = registry.counter(
+    "openbmclapi_scrub_files_total",
+    "Stored files verified by the scrubber, by result.",
+    ["result"],
+)
+scrub_bytes = registry.counter(
+    "openbmclapi_scrub_bytes_total",
+    "Bytes hashed by the scrubber.",
+)
+filelist_parse_duration = registry.gauge(
+    "openbmclapi_filelist_parse_seconds",
+    "Time spent decompressing and parsing the last file list.",
+)
+filelist_files = registry.gauge(
+    "openbmclapi_filelist_files",
+    "Files in the last parsed file list.",
+)
+startup_duration = registry.gauge(
+    "openbmclapi_startup_seconds",
+    "Seconds from process start until the node reached a startup phase.",
+    ["phase"],
+)
+process_memory = registry.gauge(
+    "openbmclapi_process_resident_memory_bytes",
+    "Resident memory of this process.",
+)
+loop_lag = registry.histogram(
+    "openbmclapi_event_loop_lag_seconds",
+    "Delay between a scheduled wake-up of the event loop and the actual one.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+
+
+def residentMemory() -> float:
+    import psutil
+
+    return psutil.Process().memory_info().rss
+
+
+process_memory.setFunction(residentMemory)
+
+
+async def monitorLoopLag(interval: float = 0.5) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0.0, loop.time() - start - interval))
@@ -1,14 +1,22 @@
+from core.agents import OTHER, normalizeAgent
 from sqlalchemy import create_engine, select
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import Mapped, mapped_column, Session, DeclarativeBase
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
 from calendar import monthrange
-from typing import List, Dict
-from re import Match
+from typing import Any, Callable, List, Dict, Tuple, TypeVar
+import asyncio
 import time
-import re
+
+T = TypeVar("T")
 
 engine = create_engine("sqlite:///database/data.db")
 session = Session(engine)
+# Writes handed off the event loop run here one after another. They use their
+# own sessions, the shared `session` belongs to the event loop thread and
+# only reads. Readers expire it first so rows written since aren't stale.
+executor = ThreadPoolExecutor(1, thread_name_prefix="orm")
 
 
 class Base(DeclarativeBase):
@@ -30,33 +38,134 @@ class AgentInfo(Base):
     hits: Mapped[int]
 
 
+class HotFileInfo(Base):
+    __tablename__ = "hot_file_info"
+
+    hash: Mapped[str] = mapped_column(primary_key=True)
+    hits: Mapped[int]
+    error: Mapped[int]
+    bytes: Mapped[int]
+
+
+class ScrubProgress(Base):
+    __tablename__ = "scrub_progress"
+
+    storage: Mapped[str] = mapped_column(primary_key=True)
+    cursor: Mapped[str]
+    finished: Mapped[int]
+
+
 def create() -> None:
     Base.metadata.create_all(engine)
 
 
+async def submit(function: Callable[..., T], *args: Any) -> T:
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, function, *args
+    )
+
+
 def writeHits(hits: int, bytes: int) -> None:
     if hits == 0 and bytes == 0:
         return
-    session.add(HitsInfo(hits=hits, bytes=bytes, time=int(time.time())))
-    try:
-        session.commit()
-    except Exception:
-        session.rollback()
-
-
-def writeAgent(agent: str, hits: int) -> None:
-    regex = re.match(r"^(.*?)/", agent) or Match()
-    if regex.group(1) not in ["bmclapi-ctrl", "bmclapi-warden"]:
-        agent_info = session.get(AgentInfo, agent)
-        if agent_info:
-            agent_info.hits += hits
+    with Session(engine) as own:
+        now = int(time.time())
+        # Two reports within the same second add up.
+        if info := own.get(HitsInfo, now):
+            info.hits += hits
+            info.bytes += bytes
         else:
-            session.add(AgentInfo(agent=agent, hits=hits))
+            own.add(HitsInfo(hits=hits, bytes=bytes, time=now))
+        try:
+            own.commit()
+        except Exception:
+            own.rollback()
+
+
+def writeAgents(agents: Dict[str, int], capacity: int) -> None:
+    """
+    Adds request counts per user-agent family and keeps only the `capacity`
+    largest families, the rest is folded into OTHER.
+    """
+    if not agents:
+        return
+    with Session(engine) as own:
+        try:
+            # Writing first takes the database lock, so other processes can't
+            # change the table between the read and the rewrite below.
+            for agent, hits in agents.items():
+                own.execute(
+                    insert(AgentInfo)
+                    .values(agent=agent, hits=hits)
+                    .on_conflict_do_update(
+                        index_elements=[AgentInfo.agent],
+                        set_={"hits": AgentInfo.hits + hits},
+                    )
+                )
+            rows = {
+                row.agent: row.hits
+                for row in own.execute(select(AgentInfo)).scalars().all()
+            }
+            totals: Dict[str, int] = {}
+            for agent, hits in rows.items():
+                # Rows from before families were tracked are merged as well.
+                family = normalizeAgent(agent) or OTHER
+                totals[family] = totals.get(family, 0) + hits
+            ranked = sorted(
+                (agent for agent in totals if agent != OTHER),
+                key=totals.__getitem__,
+                reverse=True,
+            )
+            kept = {agent: totals[agent] for agent in ranked[:capacity]}
+            other = totals.get(OTHER, 0) + sum(
+                totals[agent] for agent in ranked[capacity:]
+            )
+            if other:
+                kept[OTHER] = other
+            if kept != rows:
+                own.query(AgentInfo).delete()
+                own.add_all(
+                    AgentInfo(agent=agent, hits=hits) for agent, hits in kept.items()
+                )
+            own.commit()
+        except Exception:
+            own.rollback()
+
+
+def writeHotFiles(entries: List[Tuple[str, int, int, int]]) -> None:
+    with Session(engine) as own:
+        try:
+            own.query(HotFileInfo).delete()
+            own.add_all(
+                HotFileInfo(hash=hash, hits=hits, error=error, bytes=bytes)
+                for hash, hits, error, bytes in entries
+            )
+            own.commit()
+        except Exception:
+            own.rollback()
+
+
+def getHotFiles() -> List[Tuple[str, int, int, int]]:
+    session.expire_all()
+    return [
+        (item.hash, item.hits, item.error, item.bytes)
+        for item in session.execute(select(HotFileInfo)).scalars().all()
+    ]
+
+
+def getScrubProgress(storage: str) -> Tuple[str, int]:
+    session.expire_all()
+    progress = session.get(ScrubProgress, storage)
+    return (progress.cursor, progress.finished) if progress else ("", 0)
+
 
+def writeScrubProgress(storage: str, cursor: str, finished: int) -> None:
+    with Session(engine) as own:
         try:
-            session.commit()
+            own.merge(ScrubProgress(storage=storage, cursor=cursor, finished=finished))
+            own.commit()
         except Exception:
-            session.rollback()
+            own.rollback()
 
 
 def getHourlyHits() -> Dict[str, List[Dict[str, int]]]:
@@ -83,6 +192,7 @@ def getHourlyHits() -> Dict[str, List[Dict[str, int]]]:
             ]
         ]
 
+    session.expire_all()
     current = datetime.now().replace(hour=1, minute=0, second=0, microsecond=0)
     previous = current - timedelta(days=1)
     return {"stats": fetchData(current), "prevStats": fetchData(previous)}
@@ -111,6 +221,7 @@ def getDailyHits() -> Dict[str, List[Dict[str, int]]]:
             ]
         ]
 
+    session.expire_all()
     now = datetime.now()
     current_year, current_month = now.year, now.month
     previous_year, previous_month = (
@@ -156,6 +267,7 @@ def getMonthlyHits() -> Dict[str, List[Dict[str, int]]]:
             ]
         ]
 
+    session.expire_all()
     now = datetime.now()
     current_year = now.year
     previous_year = current_year - 1
@@ -164,6 +276,7 @@ def getMonthlyHits() -> Dict[str, List[Dict[str, int]]]:
 
 
 def getAgentInfo() -> Dict[str, int]:
+    session.expire_all()
     agents_info = session.execute(select(AgentInfo)).scalars().all()
 
     return {agent.agent: agent.hits for agent in agents_info}
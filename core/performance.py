@@ -0,0 +1,53 @@
+from core.config import Config
+from core.logger import logger
+from aiohttp import http_parser, web_fileresponse
+from typing import Any, Callable, Dict
+import asyncio
+import os
+import socket
+
+# First file descriptor passed by systemd socket activation.
+SD_LISTEN_FDS_START = 3
+
+
+def loopFactory() -> Callable[[], asyncio.AbstractEventLoop] | None:
+    if not Config.settings.advanced.performance.uvloop:
+        return None
+    try:
+        import uvloop
+    except ImportError:
+        logger.twarning("performance.warn.uvloop_missing")
+        return None
+    return uvloop.new_event_loop
+
+
+def checkAccelerations() -> None:
+    loop = type(asyncio.get_running_loop())
+    logger.tinfo("performance.info.loop", loop=f"{loop.__module__}.{loop.__name__}")
+    if http_parser.HttpRequestParser is http_parser.HttpRequestParserPy:
+        logger.twarning("performance.warn.http_parser")
+    if web_fileresponse.NOSENDFILE or not hasattr(os, "sendfile"):
+        logger.twarning("performance.warn.sendfile")
+
+
+def runnerOptions() -> Dict[str, Any]:
+    return {
+        # Shutdown waits this long for in-flight requests before cutting them.
+        "shutdown_timeout": Config.settings.advanced.drain_timeout,
+        "keepalive_timeout": Config.settings.advanced.performance.keepalive_timeout,
+        "handler_cancellation": Config.settings.advanced.performance.handler_cancellation,
+    }
+
+
+def siteOptions() -> Dict[str, Any]:
+    return {"backlog": Config.settings.advanced.performance.backlog}
+
+
+def inheritedSocket() -> socket.socket | None:
+    # A socket held by systemd survives restarts, so connections made while
+    # the new process starts wait in its backlog instead of being refused.
+    if os.environ.get("LISTEN_PID") != str(os.getpid()):
+        return None
+    if int(os.environ.get("LISTEN_FDS", "0")) < 1:
+        return None
+    return socket.socket(fileno=SD_LISTEN_FDS_START)
@@ -0,0 +1,47 @@
+from core.classes import FileInfo, FileList
+from typing import Dict
+import asyncio
+
+
+class SyncPlan:
+    """
+    Orders the files of a synchronisation by expected popularity and tracks
+    which share of the expected requests the storages can already serve.
+
+    Files are weighted by their persisted hit count plus one, so without any
+    history every file counts the same. Popular files go first, ties go to
+    the smaller file since it becomes servable sooner. `ready` is set once
+    the covered share reaches `threshold`.
+    """
+
+    def __init__(
+        self,
+        filelist: FileList,
+        missing: FileList,
+        hits: Dict[str, int],
+        threshold: float,
+    ) -> None:
+        self.total = sum(1 + hits.get(file.hash, 0) for file in filelist.files)
+        # hash -> weight of the files not stored yet
+        self.pending = {file.hash: 1 + hits.get(file.hash, 0) for file in missing.files}
+        self.covered = self.total - sum(self.pending.values())
+        self.files = FileList(
+            files=sorted(
+                missing.files, key=lambda file: (-self.pending[file.hash], file.size)
+            )
+        )
+        self.threshold = threshold
+        self.ready = asyncio.Event()
+        self.check()
+
+    @property
+    def coverage(self) -> float:
+        return self.covered / self.total if self.total else 1.0
+
+    def done(self, file: FileInfo) -> None:
+        self.covered += self.pending.pop(file.hash, 0)
+        self.check()
+
+    def check(self) -> None:
+        if self.coverage >= self.threshold:
+            self.ready.set()
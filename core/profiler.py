@@ -0,0 +1,174 @@
+from core.config import Config
+from core.logger import logger
+from core import metrics
+from collections import Counter
+from collections.abc import Coroutine
+from typing import Any
+import asyncio
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import traceback
+
+blocked = metrics.registry.counter(
+    "openbmclapi_event_loop_blocked_total",
+    "Times a callback held the event loop longer than the blocking threshold.",
+)
+coroutine_seconds = metrics.registry.counter(
+    "openbmclapi_coroutine_seconds_total",
+    "Wall time spent running each coroutine on the event loop.",
+    ["coroutine"],
+)
+coroutine_steps = metrics.registry.counter(
+    "openbmclapi_coroutine_steps_total",
+    "Times each coroutine has been resumed by the event loop.",
+    ["coroutine"],
+)
+
+
+class BlockingDetector:
+    def __init__(self, threshold: float) -> None:
+        self.threshold = threshold
+        self.interval = min(threshold / 2, 0.1)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread_id = 0
+        self.beat = time.monotonic()
+        self.thread: threading.Thread | None = None
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+        self.heartbeat()
+        self.thread = threading.Thread(
+            target=self.watch, name="loop-blocking-detector", daemon=True
+        )
+        self.thread.start()
+
+    def heartbeat(self) -> None:
+        self.beat = time.monotonic()
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_later(self.interval, self.heartbeat)
+
+    def watch(self) -> None:
+        reported = 0.0
+        while self.loop and not self.loop.is_closed():
+            time.sleep(self.interval)
+            beat = self.beat
+            stalled = time.monotonic() - beat
+            if stalled < self.threshold or reported == beat:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            blocked.inc()
+            logger.twarning(
+                "profiler.warn.blocked",
+                duration=f"{stalled:.3f}",
+                stack="".join(traceback.format_stack(frame)),
+            )
+
+
+class TimedCoroutine(Coroutine):
+    __slots__ = ("coro", "seconds", "steps")
+
+    def __init__(self, coro: Coroutine) -> None:
+        self.coro = coro
+        name = getattr(coro, "__qualname__", type(coro).__qualname__)
+        self.seconds = coroutine_seconds.labels(name)
+        self.steps = coroutine_steps.labels(name)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.coro, name)
+
+    def send(self, value: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return self.coro.send(value)
+        finally:
+            self.seconds.inc(time.perf_counter() - start)
+            self.steps.inc()
+
+    def throw(self, *args) -> Any:
+        start = time.perf_counter()
+        try:
+            return self.coro.throw(*args)
+        finally:
+            self.seconds.inc(time.perf_counter() - start)
+            self.steps.inc()
+
+    def close(self) -> None:
+        self.coro.close()
+
+    def __await__(self):
+        return self.coro.__await__()
+
+
+def timedTaskFactory(loop: asyncio.AbstractEventLoop, coro: Coroutine, **kwargs):
+    return asyncio.Task(TimedCoroutine(coro), loop=loop, **kwargs)
+
+
+class Profiler:
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.detector: BlockingDetector | None = None
+        self.thread_id = 0
+
+    def install(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.thread_id = threading.get_ident()
+        threshold = Config.settings.advanced.profiler.block_threshold
+        if threshold and threshold > 0:
+            self.detector = BlockingDetector(threshold)
+            self.detector.start(loop)
+        if Config.settings.advanced.profiler.task_timing:
+            loop.set_task_factory(timedTaskFactory)
+
+    async def profile(self, seconds: float) -> str:
+        async with self.lock:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+            output = io.StringIO()
+            pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(
+                80
+            )
+            return output.getvalue()
+
+    async def sample(self, seconds: float, interval: float = 0.005) -> str:
+        async with self.lock:
+            stacks: Counter = Counter()
+            stop = threading.Event()
+
+            def sampler() -> None:
+                while not stop.wait(interval):
+                    frame = sys._current_frames().get(self.thread_id)
+                    if frame is None:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(
+                            f"{code.co_qualname} ({code.co_filename}:{code.co_firstlineno})"
+                        )
+                        frame = frame.f_back
+                    stacks[";".join(reversed(stack))] += 1
+
+            thread = threading.Thread(target=sampler, name="loop-sampler", daemon=True)
+            thread.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                stop.set()
+                await asyncio.to_thread(thread.join)
+            return "".join(
+                f"{stack} {count}\n" for stack, count in stacks.most_common()
+            )
+
+
+profiler = Profiler()
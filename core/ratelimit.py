@@ -0,0 +1,280 @@
+from core.config import Config, Section
+from core import metrics
+from aiohttp import hdrs, web
+from aiohttp.abc import AbstractStreamWriter
+from aiohttp.web_fileresponse import NOSENDFILE
+from collections import OrderedDict, deque
+from typing import IO, Any, Deque, Dict, Tuple
+import asyncio
+import time
+
+CHUNK_SIZE = 64 * 1024
+
+delayed_chunks = metrics.registry.counter(
+    "openbmclapi_ratelimit_delayed_chunks_total",
+    "Response chunks that had to wait for bandwidth.",
+)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.capacity = max(rate * burst, CHUNK_SIZE)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: int, now: float) -> float:
+        self.refill(now)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class Client:
+    __slots__ = ("bucket", "waiters")
+
+    def __init__(self, bucket: TokenBucket | None) -> None:
+        self.bucket = bucket
+        self.waiters: Deque[Tuple[asyncio.Future, int]] = deque()
+
+
+class Shaper:
+    """
+    Egress shaper with a global and a per-client token bucket.
+
+    Chunks within both budgets are sent right away. Others are queued per
+    client and granted round-robin by a single pump task, so clients share
+    the bandwidth fairly and only one timer is armed no matter how many
+    transfers are waiting.
+    """
+
+    def __init__(self, rate: float, per_client: float, burst: float) -> None:
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.per_client = per_client
+        self.burst = burst
+        self.clients: Dict[str, Client] = {}
+        self.ready: OrderedDict[str, None] = OrderedDict()
+        self.pump: asyncio.Task | None = None
+
+    def configure(self, rate: float, per_client: float, burst: float) -> None:
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.per_client = per_client
+        self.burst = burst
+        for client in self.clients.values():
+            client.bucket = TokenBucket(per_client, burst) if per_client > 0 else None
+
+    @property
+    def enabled(self) -> bool:
+        return self.bucket is not None or self.per_client > 0
+
+    async def acquire(self, key: str, amount: int) -> None:
+        while amount > 0:
+            size = min(amount, CHUNK_SIZE)
+            amount -= size
+            await self.acquireChunk(key, size)
+
+    async def acquireChunk(self, key: str, size: int) -> None:
+        client = self.clients.get(key)
+        if client is None:
+            if len(self.clients) > 4096:
+                self.sweep()
+            client = self.clients[key] = Client(
+                TokenBucket(self.per_client, self.burst)
+                if self.per_client > 0
+                else None
+            )
+        # Chunks only queue when a bucket is short. Other clients waiting for
+        # their own bucket don't hold this one back, but the client's earlier
+        # chunks still go first.
+        if not client.waiters and not self.delay(client, size, time.monotonic()):
+            self.consume(client, size)
+            return
+
+        delayed_chunks.inc()
+        future = asyncio.get_running_loop().create_future()
+        client.waiters.append((future, size))
+        self.ready[key] = None
+        if self.pump is None or self.pump.done():
+            self.pump = asyncio.create_task(self.run())
+        await future
+
+    def delay(self, client: Client, size: int, now: float) -> float:
+        return max(
+            self.bucket.delay(size, now) if self.bucket else 0.0,
+            client.bucket.delay(size, now) if client.bucket else 0.0,
+        )
+
+    def consume(self, client: Client, size: int) -> None:
+        if self.bucket:
+            self.bucket.tokens -= size
+        if client.bucket:
+            client.bucket.tokens -= size
+
+    async def run(self) -> None:
+        while self.ready:
+            now = time.monotonic()
+            wait = 0.0
+            for key in list(self.ready):
+                client = self.clients[key]
+                while client.waiters and client.waiters[0][0].done():
+                    client.waiters.popleft()
+                if not client.waiters:
+                    del self.ready[key]
+                    continue
+                future, size = client.waiters[0]
+                delay = self.delay(client, size, now)
+                if delay:
+                    wait = min(wait, delay) if wait else delay
+                    continue
+                self.consume(client, size)
+                client.waiters.popleft()
+                future.set_result(None)
+                if client.waiters:
+                    self.ready.move_to_end(key)
+                else:
+                    del self.ready[key]
+            await asyncio.sleep(wait)
+
+    def sweep(self) -> None:
+        now = time.monotonic()
+        for key in [
+            key
+            for key, client in self.clients.items()
+            if not client.waiters and (client.bucket is None or client.bucket.full(now))
+        ]:
+            del self.clients[key]
+
+
+async def sendfile(
+    request: web.BaseRequest,
+    writer: AbstractStreamWriter,
+    fobj: IO[Any],
+    offset: int,
+    count: int,
+) -> None:
+    loop = asyncio.get_running_loop()
+    client = request.remote or ""
+    transport = request.transport
+    if not NOSENDFILE and transport is not None:
+        try:
+            while count > 0:
+                size = min(CHUNK_SIZE, count) if shaper.enabled else count
+                if shaper.enabled:
+                    await shaper.acquire(client, size)
+                await loop.sendfile(transport, fobj, offset, size)
+                offset += size
+                count -= size
+            return
+        except NotImplementedError:
+            pass
+
+    await loop.run_in_executor(None, fobj.seek, offset)
+    while count > 0:
+        size = min(CHUNK_SIZE, count)
+        if shaper.enabled:
+            await shaper.acquire(client, size)
+        chunk = await loop.run_in_executor(None, fobj.read, size)
+        if not chunk:
+            break
+        await writer.write(chunk)
+        count -= len(chunk)
+    await writer.drain()
+
+
+class ShapedFileResponse(web.FileResponse):
+    async def _sendfile(
+        self, request: web.BaseRequest, fobj: IO[Any], offset: int, count: int
+    ) -> AbstractStreamWriter:
+        if not shaper.enabled or self.compression:
+            return await super()._sendfile(request, fobj, offset, count)
+
+        writer = await web.StreamResponse.prepare(self, request)
+        assert writer is not None
+        await sendfile(request, writer, fobj, offset, count)
+        await web.StreamResponse.write_eof(self)
+        return writer
+
+
+class FileSliceResponse(web.StreamResponse):
+    def __init__(
+        self,
+        path: str,
+        offset: int,
+        count: int,
+        status: int = 200,
+        headers: Dict[str, str] | None = None,
+    ) -> None:
+        super().__init__(status=status, headers=headers)
+        self.path = path
+        self.offset = offset
+        self.count = count
+        self.content_length = count
+        self.content_type = "application/octet-stream"
+
+    async def prepare(self, request: web.BaseRequest) -> AbstractStreamWriter | None:
+        if self.prepared:
+            return self._payload_writer
+        loop = asyncio.get_running_loop()
+        fobj = await loop.run_in_executor(None, open, self.path, "rb")
+        try:
+            writer = await super().prepare(request)
+            assert writer is not None
+            if request.method != hdrs.METH_HEAD:
+                await sendfile(request, writer, fobj, self.offset, self.count)
+            await super().write_eof()
+            return writer
+        finally:
+            await loop.run_in_executor(None, fobj.close)
+
+
+class BufferResponse(web.StreamResponse):
+    def __init__(
+        self,
+        body: memoryview,
+        status: int = 200,
+        headers: Dict[str, str] | None = None,
+    ) -> None:
+        super().__init__(status=status, headers=headers)
+        self.body = body
+        self.content_length = len(body)
+        self.content_type = "application/octet-stream"
+
+    async def prepare(self, request: web.BaseRequest) -> AbstractStreamWriter | None:
+        if self.prepared:
+            return self._payload_writer
+        writer = await super().prepare(request)
+        assert writer is not None
+        if request.method != hdrs.METH_HEAD:
+            if shaper.enabled:
+                client = request.remote or ""
+                for start in range(0, len(self.body), CHUNK_SIZE):
+                    chunk = self.body[start : start + CHUNK_SIZE]
+                    await shaper.acquire(client, len(chunk))
+                    await writer.write(chunk)
+            else:
+                await writer.write(self.body)
+        await super().write_eof()
+        return writer
+
+
+def configureShaper(settings: Section) -> None:
+    # Every serving process shapes its own traffic, so the global budget is
+    # split between them.
+    processes = max(0, settings.advanced.workers) + 1
+    ratelimit = settings.advanced.ratelimit
+    shaper.configure(
+        ratelimit.global_ / processes, ratelimit.per_client, ratelimit.burst
+    )
+
+
+shaper = Shaper(0, 0, 1.0)
+configureShaper(Config.settings)
+Config.onReload(configureShaper)
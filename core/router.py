@@ -1,57 +1,216 @@
-from core.orm import writeAgent
+from core.orm import writeAgents, writeHotFiles, getHotFiles, submit
+from core.agents import AgentStats
 from core.api import getStatus
-from core.storages import AListStorage
+from core.config import Config, Section
+from core.exceptions import ConfigValueError
+from core.scheduler import scheduler, IntervalTrigger
+from core.sketch import SpaceSaving
+from core.profiler import profiler
+from core.ratelimit import shaper
+from core.signature import Signer
+from core.admission import Admission
+from core.measure import MEASURE_CHUNK, MAX_SIZE, MIB, measure_file
+from core.static import StaticAssets
+from core.storages import AListStorage, TieredStorage
 from core.logger import logger
-from aiohttp import web
-from typing import Union
+from core import metrics
+from aiohttp import hdrs, web
+from aiohttp.abc import AbstractAccessLogger
+from typing import Awaitable, Callable, Dict, List, Union
 from multidict import MultiMapping
 import aiohttp
-import base64
-import hashlib
+import asyncio
+import hmac
+import json
+import math
 import time
 import random
 
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+FORWARDED_HEADERS = (hdrs.AUTHORIZATION, hdrs.CONTENT_TYPE, hdrs.ACCEPT)
+
+
+class AccessLogger(AbstractAccessLogger):
+    def log(
+        self, request: web.BaseRequest, response: web.StreamResponse, elapsed: float
+    ) -> None:
+        resource = request.match_info.route.resource
+        route = (resource.canonical or "/") if resource else "unmatched"
+        metrics.http_request_duration.labels(route).observe(elapsed)
+        metrics.http_requests.labels(route, str(response.status)).inc()
+        # The metrics above are recorded even with the access log turned off.
+        if (
+            logger.access
+            and Config.settings.advanced.performance.access_log
+            and random.random() < Config.settings.advanced.logging.access_sample
+        ):
+            logger.access.info(
+                json.dumps(
+                    {
+                        "time": round(time.time(), 3),
+                        "remote": request.remote,
+                        "method": request.method,
+                        "path": request.path,
+                        "route": route,
+                        "status": response.status,
+                        "bytes": response.content_length,
+                        "duration": round(elapsed, 6),
+                        "agent": request.headers.get("User-Agent", ""),
+                    },
+                    ensure_ascii=False,
+                ),
+            )
+
 
 class Router:
     def __init__(self, app: web.Application, cluster) -> None:
         self.app = app
-        self.secret = cluster.secret
+        self.signer = Signer(
+            cluster.secret, Config.settings.advanced.signature.cache_size
+        )
         self.storages = cluster.storages
         self.counters = {"hits": 0, "bytes": 0}
         self.route = web.RouteTableDef()
         self.cluster = cluster
         self.ws_clients = []
-        self.connection = 0
+        self.admission = Admission(
+            Config.settings.advanced.admission.max_transfers,
+            Config.settings.advanced.admission.queue,
+            Config.settings.advanced.admission.queue_timeout,
+        )
+        self.hot_files = SpaceSaving(Config.settings.advanced.hot_files.capacity)
+        self.agents = AgentStats(Config.settings.advanced.agents.capacity)
+        self.assets = StaticAssets("./assets/dashboard")
+        metrics.http_inflight.setFunction(lambda: self.connection)
+        Config.onReload(self.applySettings)
+
+    @property
+    def connection(self) -> int:
+        return self.admission.active
 
-    def checkSign(self, hash: str, secret: str, query: MultiMapping) -> bool:
+    def checkSign(self, hash: str, query: MultiMapping) -> bool:
         if not (s := query.get("s")) or not (e := query.get("e")):
             return False
-        sign = (
-            base64.urlsafe_b64encode(
-                hashlib.sha1(f"{secret}{hash}{e}".encode()).digest()
-            )
-            .decode()
-            .rstrip("=")
+        return self.signer.verify(hash, s, e)
+
+    def checkAdmin(self, request: web.Request) -> bool:
+        token = Config.settings.advanced.admin.token
+        if not token:
+            return False
+        return hmac.compare_digest(
+            request.headers.get("Authorization", "").encode(),
+            f"Bearer {token}".encode(),
         )
-        return sign == s and time.time() < int(e, 36)
+
+    def applySettings(self, settings: Section) -> None:
+        admission = settings.advanced.admission
+        self.admission.limit = admission.max_transfers
+        self.admission.queue = admission.queue
+        self.admission.timeout = admission.queue_timeout
+
+    def reloadConfig(self) -> Dict[str, List[str]]:
+        try:
+            applied, ignored = Config.reload()
+        except ConfigValueError as e:
+            logger.terror("config.error.reload", e=e)
+            raise
+        logger.tsuccess("config.success.reloaded", keys=", ".join(applied) or "-")
+        if ignored:
+            logger.twarning("config.warn.restart_required", keys=", ".join(ignored))
+        if self.cluster.workers:
+            self.cluster.workers.reload()
+        return {"applied": applied, "ignored": ignored}
+
+    def loadHotFiles(self) -> None:
+        self.hot_files.load(getHotFiles())
+
+    async def saveHotFiles(self) -> None:
+        if self.cluster.workers:
+            self.cluster.workers.receive()
+        await submit(writeHotFiles, self.hot_files.top())
+
+    async def saveAgents(self) -> None:
+        if self.cluster.workers:
+            self.cluster.workers.receive()
+        await submit(
+            writeAgents, self.agents.take(), Config.settings.advanced.agents.capacity
+        )
+
+    def primaryOnly(self, handler: Handler) -> Handler:
+        """
+        Endpoints whose answer depends on process state go to the primary
+        process when running in a worker, so every request sees the same
+        metrics, hot files and profiler.
+        """
+        if not self.cluster.primary:
+            return handler
+
+        async def forward(request: web.Request) -> web.Response:
+            async with aiohttp.ClientSession(
+                connector=aiohttp.UnixConnector(path=self.cluster.primary),
+                timeout=aiohttp.ClientTimeout(total=None),
+            ) as session:
+                async with session.request(
+                    request.method,
+                    f"http://primary{request.path_qs}",
+                    headers={
+                        name: value
+                        for name, value in request.headers.items()
+                        if name in FORWARDED_HEADERS
+                    },
+                    data=await request.read(),
+                ) as response:
+                    return web.Response(
+                        body=await response.read(),
+                        status=response.status,
+                        headers={
+                            name: value
+                            for name, value in response.headers.items()
+                            if name == hdrs.CONTENT_TYPE
+                        },
+                    )
+
+        return forward
 
     def init(self) -> None:
         @self.route.get("/download/{hash}")
         async def _(
             request: web.Request,
         ) -> Union[web.Response, web.FileResponse]:
-            self.connection += 1
-            writeAgent(request.headers["User-Agent"], 1)
+            if not await self.admission.acquire():
+                return web.Response(
+                    text="Too many concurrent transfers.",
+                    status=503,
+                    headers={
+                        "Retry-After": str(
+                            Config.settings.advanced.admission.retry_after
+                        )
+                    },
+                )
+            # aiohttp sends the body in this same task after the handler
+            # returns, so the slot is held until the transfer is over.
+            task = asyncio.current_task()
+            assert task is not None
+            task.add_done_callback(lambda _: self.admission.release())
+
+            self.agents.add(request.headers.get("User-Agent", ""))
             file_hash = request.match_info.get("hash", "").lower()
-            if not self.checkSign(file_hash, self.secret, request.query):
+            if not self.checkSign(file_hash, request.query):
                 return web.Response(text="Invalid signature.", status=403)
 
-            response = await random.choice(self.storages).express(
-                file_hash, self.counters
-            )
+            storage = random.choice(self.storages)
+            name = type(storage).__name__
+            counter = {"hits": 0, "bytes": 0}
+            with metrics.storage_express_duration.labels(name).time():
+                response = await storage.express(file_hash, counter)
+            self.counters["hits"] += counter["hits"]
+            self.counters["bytes"] += counter["bytes"]
+            metrics.storage_hits.labels(name).inc(counter["hits"])
+            metrics.storage_bytes_served.labels(name).inc(counter["bytes"])
+            if counter["hits"]:
+                self.hot_files.add(file_hash, counter["bytes"])
 
-            self.connection -= 1
-            logger.debug(response)
+            logger.lazy.debug("{}", lambda: response)
             return response
 
         @self.route.get("/measure/{size}")
@@ -60,31 +219,38 @@ class Router:
                 size = int(request.match_info.get("size", "0"))
 
                 if (
-                    not self.checkSign(f"/measure/{size}", self.secret, request.query)
-                    or size > 200
+                    not self.checkSign(f"/measure/{size}", request.query)
+                    or size > MAX_SIZE
                 ):
-                    return web.HTTPForbidden() if size > 200 else web.HTTPBadRequest()
+                    return (
+                        web.HTTPForbidden() if size > MAX_SIZE else web.HTTPBadRequest()
+                    )
 
-                response = None
                 for storage in self.storages:
+                    if isinstance(storage, TieredStorage):
+                        storage = storage.origin
                     if isinstance(storage, AListStorage):
                         url = await storage.measure(size)
-                        response = web.HTTPFound(url)
-                        return response
+                        if url:
+                            return web.HTTPFound(url)
+
+                if Config.settings.advanced.measure.sendfile:
+                    return await measure_file.response(size)
 
-                buffer = b"\x00\x66\xcc\xff" * 256 * 1024
                 response = web.StreamResponse(
                     status=200,
                     reason="OK",
                     headers={
-                        "Content-Length": str(size * 1024 * 1024),
+                        "Content-Length": str(size * MIB),
                         "Content-Type": "application/octet-stream",
                     },
                 )
 
                 await response.prepare(request)
                 for _ in range(size):
-                    await response.write(buffer)
+                    if shaper.enabled:
+                        await shaper.acquire(request.remote or "", len(MEASURE_CHUNK))
+                    await response.write(MEASURE_CHUNK)
                 await response.write_eof()
                 return response
 
@@ -92,9 +258,63 @@ class Router:
                 return web.Response(status=400)
 
         @self.route.get("/api/status")
+        @self.primaryOnly
         async def _(_: web.Request) -> web.Response:
             return await getStatus(self.cluster)
 
+        @self.route.get("/api/hot")
+        @self.primaryOnly
+        async def _(request: web.Request) -> web.Response:
+            try:
+                limit = int(request.query.get("limit", "50"))
+            except ValueError:
+                return web.HTTPBadRequest()
+            if self.cluster.workers:
+                self.cluster.workers.receive()
+            return web.json_response(
+                [
+                    {"hash": hash, "hits": hits, "error": error, "bytes": bytes}
+                    for hash, hits, error, bytes in self.hot_files.top(max(0, limit))
+                ]
+            )
+
+        @self.route.get("/api/admin/profile")
+        @self.primaryOnly
+        async def _(request: web.Request) -> web.Response:
+            if not self.checkAdmin(request):
+                return web.HTTPForbidden()
+            try:
+                seconds = float(request.query.get("seconds", "10"))
+            except ValueError:
+                return web.HTTPBadRequest()
+            if not math.isfinite(seconds) or seconds <= 0:
+                return web.HTTPBadRequest()
+            seconds = min(seconds, 300)
+            if profiler.lock.locked():
+                return web.HTTPConflict(text="A profile is already running.")
+            if request.query.get("mode", "cprofile") == "sample":
+                return web.Response(text=await profiler.sample(seconds))
+            return web.Response(text=await profiler.profile(seconds))
+
+        @self.route.post("/api/admin/config/reload")
+        @self.primaryOnly
+        async def _(request: web.Request) -> web.Response:
+            if not self.checkAdmin(request):
+                return web.HTTPForbidden()
+            try:
+                return web.json_response(self.reloadConfig())
+            except ConfigValueError as e:
+                return web.json_response({"error": str(e)}, status=400)
+
+        @self.route.get("/metrics")
+        @self.primaryOnly
+        async def _(_: web.Request) -> web.Response:
+            if self.cluster.workers:
+                self.cluster.workers.receive()
+            return web.Response(
+                text=metrics.registry.render(), content_type="text/plain"
+            )
+
         @self.route.get("/api/rank")
         async def _(_: web.Request) -> web.Response:
             async with aiohttp.ClientSession("https://bd.bangbang93.com") as session:
@@ -108,9 +328,32 @@ class Router:
 
         @self.route.get("/dashboard")
         @self.route.get("/dashboard/{tail:.*}")
-        async def _(_: web.Request) -> web.FileResponse:
-            return web.FileResponse("./assets/dashboard/index.html")
+        async def _(request: web.Request) -> web.Response:
+            index = self.assets.get("index.html")
+            if index is None:
+                return web.HTTPNotFound()
+            return index.response(request)
+
+        @self.route.get("/{name:.+}")
+        async def _(request: web.Request) -> web.Response:
+            asset = self.assets.get(request.match_info["name"])
+            if asset is None:
+                return web.HTTPNotFound()
+            return asset.response(request)
 
-        self.route.static("/", "./assets/dashboard")
+        self.app.add_routes(self.route)
 
-        self.app.add_routes(self.route)
\ No newline at end of file
+        if self.cluster.primary:
+            # Workers send their counts to the primary, which persists them.
+            return
+        self.loadHotFiles()
+        scheduler.add_job(
+            self.saveHotFiles,
+            IntervalTrigger(
+                seconds=Config.settings.advanced.hot_files.persist_interval
+            ),
+        )
+        scheduler.add_job(
+            self.saveAgents,
+            IntervalTrigger(seconds=Config.settings.advanced.agents.flush_interval),
+        )
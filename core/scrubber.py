@@ -0,0 +1,124 @@
+from core.classes import FileInfo, Storage
+from core.config import Config
+from core.logger import logger
+from core.orm import getScrubProgress, submit, writeScrubProgress
+from core.ratelimit import TokenBucket
+from core import metrics
+from typing import TYPE_CHECKING, Set, Union
+import asyncio
+import hashlib
+import time
+
+if TYPE_CHECKING:
+    from core.cluster import Cluster
+
+CHUNK_SIZE = 4 * 1024 * 1024
+SAVE_INTERVAL = 30
+
+
+def newHash(hash: str):
+    return hashlib.md5() if len(hash) == 32 else hashlib.sha1()
+
+
+class Scrubber:
+    """
+    Re-hashes stored files in the background so corruption is found before a
+    client downloads it.
+
+    Every storage is walked in hash order, reading through memory mappings
+    and hashing in worker threads within advanced.scrub.rate bytes per
+    second. It stays idle while the node is busy serving. The position is
+    saved regularly, so a cycle carries on after a restart. Corrupt files are
+    quarantined and downloaded again.
+    """
+
+    def __init__(self, cluster: "Cluster") -> None:
+        self.cluster = cluster
+        self.task: asyncio.Task | None = None
+        self.bucket = TokenBucket(max(1, Config.settings.advanced.scrub.rate), 1.0)
+        self.resyncs: Set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        if Config.settings.advanced.scrub.rate > 0 and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self) -> None:
+        while True:
+            for index, storage in enumerate(self.cluster.storages):
+                await self.scrub(f"{index}:{type(storage).__name__}", storage)
+            await asyncio.sleep(60)
+
+    async def scrub(self, name: str, storage: Storage) -> None:
+        cursor, finished = getScrubProgress(name)
+        interval = Config.settings.advanced.scrub.cycle_interval
+        if not cursor and finished + interval > time.time():
+            return
+        files = sorted(
+            (file for file in self.cluster.filelist.files if file.hash > cursor),
+            key=lambda file: file.hash,
+        )
+        if not files:
+            return
+        if not cursor:
+            logger.tinfo("scrub.info.started", storage=name, count=len(files))
+
+        checked = corrupt = 0
+        saved = time.monotonic()
+        for file in files:
+            result = await self.verify(storage, file)
+            if result is not None:
+                checked += 1
+                metrics.scrub_files.labels("ok" if result else "corrupt").inc()
+            if result is False:
+                corrupt += 1
+                await self.quarantine(name, storage, file)
+            if time.monotonic() - saved > SAVE_INTERVAL:
+                await submit(writeScrubProgress, name, file.hash, finished)
+                saved = time.monotonic()
+
+        await submit(writeScrubProgress, name, "", int(time.time()))
+        logger.tsuccess(
+            "scrub.success.finished", storage=name, count=checked, corrupt=corrupt
+        )
+
+    async def verify(self, storage: Storage, file: FileInfo) -> Union[bool, None]:
+        view = await asyncio.to_thread(storage.mapFile, file.hash)
+        if view is None:
+            return None
+        if len(view) != file.size:
+            return False
+        digest = newHash(file.hash)
+        for start in range(0, len(view), CHUNK_SIZE):
+            chunk = view[start : start + CHUNK_SIZE]
+            await self.throttle(len(chunk))
+            await asyncio.to_thread(digest.update, chunk)
+            metrics.scrub_bytes.inc(len(chunk))
+        return digest.hexdigest() == file.hash
+
+    async def throttle(self, size: int) -> None:
+        settings = Config.settings.advanced.scrub
+        router = self.cluster.router
+        while router and router.connection > settings.pause_connections:
+            await asyncio.sleep(1)
+        self.bucket.rate = max(1, settings.rate)
+        delay = self.bucket.delay(size, time.monotonic())
+        if delay:
+            await asyncio.sleep(delay)
+        self.bucket.tokens -= size
+
+    async def quarantine(self, name: str, storage: Storage, file: FileInfo) -> None:
+        logger.twarning("scrub.warn.corrupt", storage=name, file=file.hash)
+        try:
+            if not await storage.quarantineFile(file.hash):
+                return
+        except Exception as e:
+            logger.terror("scrub.error.quarantine", file=file.hash, e=e)
+            return
+        task = asyncio.create_task(self.cluster.restoreFile(file, storage))
+        self.resyncs.add(task)
+        task.add_done_callback(self.resyncs.discard)
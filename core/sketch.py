@@ -0,0 +1,82 @@
+from typing import Dict, Hashable, Iterable, List, Tuple
+from operator import itemgetter
+import heapq
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy hitters summary.
+
+    Keeps at most `capacity` keys. Every `add` is O(1): keys are grouped in
+    buckets by count, and when the summary is full the key with the smallest
+    count is replaced by the new one, which inherits that count as its error.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = max(1, capacity)
+        self.counts: Dict[Hashable, int] = {}
+        self.errors: Dict[Hashable, int] = {}
+        self.weights: Dict[Hashable, int] = {}
+        self.buckets: Dict[int, Dict[Hashable, None]] = {}
+        self.min_count = 0
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.counts
+
+    def add(self, key: Hashable, weight: int = 0, amount: int = 1) -> None:
+        count = self.counts.get(key)
+        if count is None:
+            if len(self.counts) < self.capacity:
+                count = error = 0
+            else:
+                count = error = self.min_count
+                evicted = next(iter(self.buckets[count]))
+                self.unlink(evicted, count)
+                del self.counts[evicted], self.errors[evicted], self.weights[evicted]
+            self.errors[key] = error
+            self.weights[key] = 0
+        else:
+            self.unlink(key, count)
+
+        count += amount
+        self.counts[key] = count
+        self.weights[key] += weight
+        self.buckets.setdefault(count, {})[key] = None
+        if self.min_count not in self.buckets:
+            # Moving up by one can't skip a bucket, larger steps can.
+            self.min_count = count if amount == 1 else min(self.buckets)
+        elif count < self.min_count:
+            self.min_count = count
+
+    def unlink(self, key: Hashable, count: int) -> None:
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+
+    def top(self, n: int | None = None) -> List[Tuple[Hashable, int, int, int]]:
+        items = (
+            heapq.nlargest(n, self.counts.items(), key=itemgetter(1))
+            if n is not None
+            else sorted(self.counts.items(), key=itemgetter(1), reverse=True)
+        )
+        return [
+            (key, count, self.errors[key], self.weights[key]) for key, count in items
+        ]
+
+    def merge(self, entries: Iterable[Tuple[Hashable, int, int, int]]) -> None:
+        for key, count, _, weight in entries:
+            self.add(key, weight, count)
+
+    def load(self, entries: Iterable[Tuple[Hashable, int, int, int]]) -> None:
+        entries = heapq.nlargest(self.capacity, entries, key=itemgetter(1))
+        self.counts = {key: count for key, count, _, _ in entries}
+        self.errors = {key: error for key, _, error, _ in entries}
+        self.weights = {key: weight for key, _, _, weight in entries}
+        self.buckets = {}
+        for key, count in self.counts.items():
+            self.buckets.setdefault(count, {})[key] = None
+        self.min_count = min(self.buckets, default=0)
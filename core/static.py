@@ -0,0 +1,123 @@
+from aiohttp import hdrs, web
+from pathlib import Path
+from typing import Dict, Tuple
+import gzip
+import hashlib
+import mimetypes
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Vite names the files it bundles into assets/ `[name]-[hash].[ext]`, the
+# hash being 8 characters of url-safe base64. Requiring an upper-case letter
+# or digit in it keeps plain names like `file-manager.js` revalidated.
+HASHED = re.compile(
+    r"^assets/[A-Za-z0-9_.-]+-(?=[A-Za-z0-9_-]*[A-Z0-9])[A-Za-z0-9_-]{8}\.[a-z0-9]+$"
+)
+COMPRESSIBLE = {".html", ".js", ".css", ".svg", ".json", ".ttf", ".eot", ".txt"}
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+class Asset:
+    __slots__ = ("bodies", "content_type", "etags", "cache_control")
+
+    def __init__(self, path: Path, cache_control: str) -> None:
+        data = path.read_bytes()
+        self.bodies: Dict[str, bytes] = {"identity": data}
+        self.content_type = (
+            mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        )
+        self.cache_control = cache_control
+        if path.suffix in COMPRESSIBLE:
+            self.compress(path, data)
+        # Every encoding is a different representation and needs its own tag.
+        digest = hashlib.sha1(data).hexdigest()[:16]
+        self.etags = {
+            encoding: (
+                f'"{digest}"' if encoding == "identity" else f'"{digest}-{encoding}"'
+            )
+            for encoding in self.bodies
+        }
+
+    def compress(self, path: Path, data: bytes) -> None:
+        # Prefer files compressed at build time, fall back to doing it here.
+        for encoding, suffix, compress in (
+            ("br", ".br", brotli and (lambda data: brotli.compress(data, quality=9))),
+            ("gzip", ".gz", lambda data: gzip.compress(data, 9, mtime=0)),
+        ):
+            prebuilt = path.with_name(path.name + suffix)
+            if prebuilt.is_file():
+                body = prebuilt.read_bytes()
+            elif compress:
+                body = compress(data)
+            else:
+                continue
+            if len(body) < len(data):
+                self.bodies[encoding] = body
+
+    def negotiate(self, accept_encoding: str) -> Tuple[str, bytes]:
+        accepted = set()
+        for token in accept_encoding.lower().split(","):
+            coding, _, params = token.partition(";")
+            _, _, quality = params.replace(" ", "").partition("q=")
+            try:
+                if quality and float(quality) <= 0:
+                    continue
+            except ValueError:
+                continue
+            accepted.add(coding.strip())
+        for encoding in ("br", "gzip"):
+            if encoding in accepted and encoding in self.bodies:
+                return encoding, self.bodies[encoding]
+        return "identity", self.bodies["identity"]
+
+    def response(self, request: web.Request) -> web.Response:
+        encoding, body = self.negotiate(request.headers.get(hdrs.ACCEPT_ENCODING, ""))
+        etag = self.etags[encoding]
+        headers = {
+            hdrs.ETAG: etag,
+            hdrs.CACHE_CONTROL: self.cache_control,
+        }
+        if len(self.bodies) > 1:
+            headers[hdrs.VARY] = hdrs.ACCEPT_ENCODING
+        if matches(request.headers.get(hdrs.IF_NONE_MATCH, ""), etag):
+            return web.Response(status=304, headers=headers)
+
+        if encoding != "identity":
+            headers[hdrs.CONTENT_ENCODING] = encoding
+        return web.Response(body=body, content_type=self.content_type, headers=headers)
+
+
+def matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, W/ prefixes are ignored.
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class StaticAssets:
+    """
+    The dashboard bundle, read and compressed once and served from memory.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.assets: Dict[str, Asset] = {}
+        base = Path(root)
+        if not base.is_dir():
+            return
+        for path in sorted(base.rglob("*")):
+            if not path.is_file() or path.suffix in (".gz", ".br"):
+                continue
+            name = path.relative_to(base).as_posix()
+            self.assets[name] = Asset(
+                path, IMMUTABLE if HASHED.match(name) else REVALIDATE
+            )
+
+    def get(self, name: str) -> Asset | None:
+        return self.assets.get(name)
@@ -1,23 +1,46 @@
 from core.classes import Storage
 from core.storages.local import LocalStorage
 from core.storages.alist import AListStorage
+from core.storages.tiered import TieredStorage
+from core.storages.pack import PackStorage
 from core.config import Config
-from typing import List
+from typing import List, Mapping, Union
 
 
-def getStorages() -> List[Storage]:
-    config = Config.get("storages")
+def createStorage(storage: Mapping, readonly: bool = False) -> Union[Storage, None]:
+    if storage["type"] == "local":
+        return LocalStorage(path=storage["path"])
+    if storage["type"] == "pack":
+        return PackStorage(path=storage["path"], readonly=readonly)
+    if storage["type"] == "alist":
+        return AListStorage(
+            username=storage["username"],
+            password=storage["password"],
+            url=storage["url"],
+            path=storage["path"],
+        )
+    if storage["type"] == "tiered":
+        origin = createStorage(storage["origin"], readonly)
+        if origin is None:
+            return None
+        return TieredStorage(
+            cache=LocalStorage(path=storage["path"]),
+            origin=origin,
+            size=storage["size"],
+            readonly=readonly,
+        )
+    return None
+
+
+def getStorages(readonly: bool = False) -> List[Storage]:
+    """
+    `readonly` is set in worker processes, which serve the storages the
+    primary process writes.
+    """
+    config = Config.settings.storages
     storages = []
     for storage in config:
-        if storage["type"] == "local":
-            storages.append(LocalStorage(path=storage["path"]))
-        if storage["type"] == "alist":
-            storages.append(
-                AListStorage(
-                    username=storage["username"],
-                    password=storage["password"],
-                    url=storage["url"],
-                    path=storage["path"],
-                )
-            )
+        storage = createStorage(storage, readonly)
+        if storage is not None:
+            storages.append(storage)
     return storages
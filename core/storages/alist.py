@@ -2,7 +2,9 @@ from core.classes import Storage, FileInfo, FileList
 from core.scheduler import scheduler, IntervalTrigger
 from core.logger import logger
 from core.i18n import locale
-from typing import List, Set, Tuple, Dict, Any
+from core.config import Config
+from core.measure import MIB, measureChunks
+from typing import List, Set, Tuple, Dict, Any, Union
 from tqdm import tqdm
 from aiohttp import web
 import aiohttp
@@ -10,6 +12,7 @@ import secrets
 import io
 import asyncio
 import humanize
+import time
 
 
 class AListStorage(Storage):
@@ -21,6 +24,7 @@ class AListStorage(Storage):
         self.token = ""
         self.scheduler = None
         self.headers = {}
+        self.measure_urls: Dict[int, Tuple[str, float]] = {}
 
     async def init(self) -> None:
         async def fetchToken() -> None:
@@ -48,6 +52,9 @@ class AListStorage(Storage):
                 self.scheduler = scheduler.add_job(fetchToken, IntervalTrigger(days=2))
 
         await fetchToken()
+        await asyncio.gather(
+            *(self.measure(size) for size in Config.settings.advanced.measure.sizes)
+        )
 
     async def check(self) -> None:
         file_name = secrets.token_hex(8)
@@ -127,6 +134,10 @@ class AListStorage(Storage):
         return FileList(files=missing_files)
 
     async def measure(self, size: int) -> str:
+        cached = self.measure_urls.get(size)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+
         file_path = f"{self.path}/measure/.{size}"
         try:
             async with aiohttp.ClientSession(self.url, headers=self.headers) as session:
@@ -135,19 +146,16 @@ class AListStorage(Storage):
                 )
                 response.raise_for_status()
                 data = await response.json()
-                if data["code"] == 200:
-                    return data["data"]["raw_url"]
                 if data["code"] != 200:
                     try:
-                        buffer = b"\x00\x66\xcc\xff" * 256 * 1024 * size
                         response = await session.put(
                             "/api/fs/put",
-                            data=buffer,
+                            data=measureChunks(size),
                             headers={
                                 **self.headers,
                                 "File-Path": file_path,
                                 "Content-Type": "application/octet-stream",
-                                "Content-Length": str(size * 1024 * 1024),
+                                "Content-Length": str(size * MIB),
                             },
                         )
                         response.raise_for_status()
@@ -162,12 +170,19 @@ class AListStorage(Storage):
                         logger.terror("storage.error.alist.upload", e=e)
                         raise
 
-                response = await session.post(
-                    "/api/fs/get", json={"path": file_path, "password": self.password}
+                    response = await session.post(
+                        "/api/fs/get",
+                        json={"path": file_path, "password": self.password},
+                    )
+                    response.raise_for_status()
+                    data = await response.json()
+
+                url = data["data"]["raw_url"]
+                self.measure_urls[size] = (
+                    url,
+                    time.monotonic() + Config.settings.advanced.measure.url_ttl,
                 )
-                response.raise_for_status()
-                data = await response.json()
-                return data["data"]["raw_url"]
+                return url
         except Exception as e:
             logger.terror("storage.error.alist.measure", e=e)
             return ""
@@ -193,6 +208,20 @@ class AListStorage(Storage):
                 logger.debug(e)
                 return response
 
+    async def readFile(self, hash: str) -> Union[bytes, None]:
+        path = f"{self.path}/{hash[:2]}/{hash}"
+        async with aiohttp.ClientSession(self.url, headers=self.headers) as session:
+            res = await session.post(
+                "/api/fs/get", json={"path": path, "password": self.password}
+            )
+            data = await res.json()
+        if data["code"] != 200:
+            return None
+        async with aiohttp.ClientSession() as session:
+            async with session.get(data["data"]["raw_url"]) as response:
+                response.raise_for_status()
+                return await response.read()
+
     async def writeFile(
         self, file: FileInfo, content: io.BytesIO, delay: int, retry: int
     ) -> bool:
@@ -1,21 +1,146 @@
 from core.classes import Storage, FileInfo, FileList
 from core.logger import logger
 from core.i18n import locale
+from core.ratelimit import ShapedFileResponse
+from core.config import Config
 from aiohttp import web
-from typing import Union
+from typing import Dict, List, Tuple, Union
 from tqdm import tqdm
 from pathlib import Path
 import os
 import io
 import aiofiles
 import asyncio
+import mmap
 import tempfile
 import humanize
 
+fdatasync = getattr(os, "fdatasync", os.fsync)
+# mkstemp creates files as 0600, give them the mode open() would have.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+class DurableWriter:
+    """
+    Writes files to a temporary name in their directory and renames them into
+    place, so a crash never leaves a partial file under the real name.
+
+    Writes are batched: one trip to a worker thread writes every queued file,
+    then syncs their data, renames them and syncs each directory once. A
+    write arriving while nothing is being written goes out right away, the
+    ones queued behind it wait up to fsync_delay to share a batch.
+    """
+
+    def __init__(self) -> None:
+        self.queue: List[Tuple[str, memoryview, asyncio.Future]] = []
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    async def write(self, path: str, data: memoryview) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.append((path, data, future))
+        if len(self.queue) >= Config.settings.advanced.storage.fsync_batch:
+            self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.wakeup.set()
+            self.task = asyncio.create_task(self.run())
+        await future
+
+    async def run(self) -> None:
+        while self.queue:
+            try:
+                await asyncio.wait_for(
+                    self.wakeup.wait(), Config.settings.advanced.storage.fsync_delay
+                )
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            batch, self.queue = self.queue, []
+            try:
+                errors = await asyncio.to_thread(
+                    self.flush,
+                    [(path, data) for path, data, _ in batch],
+                    Config.settings.advanced.storage.fsync,
+                )
+            except Exception as e:
+                errors = [e] * len(batch)
+            for (_, _, future), error in zip(batch, errors):
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+    @staticmethod
+    def flush(
+        batch: List[Tuple[str, memoryview]], fsync: bool
+    ) -> List[Union[Exception, None]]:
+        errors: List[Union[Exception, None]] = [None] * len(batch)
+        temps: List[Tuple[int, int, str]] = []
+        for i, (path, data) in enumerate(batch):
+            directory, name = os.path.split(path)
+            try:
+                fd, temp = tempfile.mkstemp(
+                    prefix=f".{name}.", suffix=".tmp", dir=directory
+                )
+            except OSError as e:
+                errors[i] = e
+                continue
+            temps.append((i, fd, temp))
+            try:
+                if hasattr(os, "fchmod"):
+                    os.fchmod(fd, 0o666 & ~UMASK)
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view) :]
+            except OSError as e:
+                errors[i] = e
+
+        # Data first, so a renamed file is never backed by unwritten blocks.
+        for i, fd, temp in temps:
+            try:
+                if fsync and errors[i] is None:
+                    fdatasync(fd)
+            except OSError as e:
+                errors[i] = e
+            finally:
+                os.close(fd)
+
+        directories: Dict[str, List[int]] = {}
+        for i, _, temp in temps:
+            try:
+                if errors[i] is None:
+                    os.replace(temp, batch[i][0])
+                    directories.setdefault(os.path.dirname(batch[i][0]), []).append(i)
+                    continue
+            except OSError as e:
+                errors[i] = e
+            try:
+                os.unlink(temp)
+            except OSError:
+                pass
+
+        # Make the renames themselves durable, once per directory.
+        if fsync and os.name != "nt":
+            for directory, indexes in directories.items():
+                try:
+                    fd = os.open(directory, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError as e:
+                    for i in indexes:
+                        errors[i] = e
+        return errors
+
 
 class LocalStorage(Storage):
     def __init__(self, path: str) -> None:
         self.path = path
+        self.writer = DurableWriter()
 
     async def init(self) -> None:
         os.makedirs(self.path, exist_ok=True)
@@ -34,26 +159,23 @@ class LocalStorage(Storage):
     ) -> bool:
         file_path = os.path.join(self.path, file.hash[:2], file.hash)
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        if Path(file_path).exists and Path(file_path).stat().st_size == len(
+        if Path(file_path).exists() and Path(file_path).stat().st_size == len(
             content.getvalue()
         ):
             return True
+        data = content.getbuffer()
+        if len(data) != file.size:
+            logger.terror(
+                "storage.error.local.write_file.size_mismatch",
+                file=file.hash,
+                file_size=humanize.naturalsize(file.size, binary=True),
+                actual_file_size=humanize.naturalsize(len(data), binary=True),
+            )
+            return False
         for _ in range(retry):
             try:
-                async with aiofiles.open(file_path, "wb") as f:
-                    await f.write(content.getbuffer())
-                    await f.close()
-                size = os.path.getsize(file_path)
-                if size == file.size:
-                    return True
-                else:
-                    logger.terror(
-                        "storage.error.local.write_file.size_mismatch",
-                        file=file.hash,
-                        file_size=humanize.naturalsize(file.size, binary=True),
-                        actual_file_size=humanize.naturalsize(size, binary=True),
-                    )
-                    return False
+                await self.writer.write(file_path, data)
+                return True
             except Exception as e:
                 logger.terror(
                     "storage.error.local.write_file.retry",
@@ -90,7 +212,7 @@ class LocalStorage(Storage):
             return response
         try:
             file_size = os.path.getsize(path)
-            response = web.FileResponse(path, status=200)
+            response = ShapedFileResponse(path, status=200)
             response.headers["x-bmclapi-hash"] = hash
             counter["bytes"] += file_size
             counter["hits"] += 1
@@ -100,6 +222,31 @@ class LocalStorage(Storage):
             logger.debug(e)
             return response
 
+    async def readFile(self, hash: str) -> Union[bytes, None]:
+        path = os.path.join(self.path, hash[:2], hash)
+        try:
+            async with aiofiles.open(path, "rb") as f:
+                return await f.read()
+        except FileNotFoundError:
+            return None
+
+    def mapFile(self, hash: str) -> Union[memoryview, None]:
+        try:
+            with open(os.path.join(self.path, hash[:2], hash), "rb") as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return memoryview(b"")
+                return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except FileNotFoundError:
+            return None
+
+    async def quarantineFile(self, hash: str) -> bool:
+        directory = os.path.join(self.path, "quarantine")
+        os.makedirs(directory, exist_ok=True)
+        os.replace(
+            os.path.join(self.path, hash[:2], hash), os.path.join(directory, hash)
+        )
+        return True
+
     async def recycleFiles(self, files: FileList) -> None:
         delete_files = []
 
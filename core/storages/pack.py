@@ -0,0 +1,516 @@
+from core.classes import Storage, FileInfo, FileList
+from core.storages.local import LocalStorage
+from core.ratelimit import BufferResponse
+from core.scheduler import scheduler, IntervalTrigger
+from core.logger import logger
+from core.config import Config
+from typing import AbstractSet, BinaryIO, Dict, Iterator, List, Set, Tuple, Union
+from pathlib import Path
+from tqdm import tqdm
+from aiohttp import web
+import asyncio
+import heapq
+import humanize
+import io
+import mmap
+import os
+import struct
+import time
+
+# magic, version, records, active pack and its size when the index was saved
+INDEX_HEADER = struct.Struct("<4sIQIQ")
+# hash, pack, offset, length
+RECORD = struct.Struct("<20sIQI")
+# written in front of every file in a pack: hash, length
+ENTRY = struct.Struct("<20sI")
+MAGIC = b"BMPK"
+VERSION = 1
+KEY_SIZE = 20
+
+Location = Tuple[int, int, int]
+# The mapped index and its number of records, replaced as a whole.
+Index = Tuple[Union[mmap.mmap, bytes], int]
+
+
+def toKey(hash: str) -> Union[bytes, None]:
+    if len(hash) > KEY_SIZE * 2:
+        return None
+    try:
+        # md5 hashes are padded to the size of sha1 ones.
+        return bytes.fromhex(hash).ljust(KEY_SIZE, b"\0")
+    except ValueError:
+        return None
+
+
+class PackStorage(Storage):
+    """
+    Appends small files to large pack files instead of storing one file each.
+
+    The index is a sorted array of fixed-size records mapped into memory and
+    binary searched, so a hit costs no system call and its body is sent from
+    a mapping of the pack. Files written since the index was last saved are
+    kept in `pending` and recovered from the tail of the packs after a crash.
+    Files larger than advanced.pack.max_object stay plain files.
+
+    Worker processes open the packs read-only: they never append, recover
+    or compact, and pick up the index and the files appended by the primary
+    when a lookup misses.
+    """
+
+    def __init__(self, path: str, readonly: bool = False) -> None:
+        self.path = path
+        self.packs = os.path.join(path, "packs")
+        self.index_path = os.path.join(path, "index")
+        self.files = LocalStorage(path)
+        self.readonly = readonly
+        self.index: Index = (b"", 0)
+        # (inode, mtime) of the mapped index and when a worker last checked it
+        self.stamp: Tuple[int, int] = (0, 0)
+        self.refreshed = 0.0
+        self.pending: Dict[bytes, Location] = {}
+        # pack -> end of its last complete file, in a worker
+        self.tails: Dict[int, int] = {}
+        # pack -> bytes still referenced by the index
+        self.live: Dict[int, int] = {}
+        self.maps: Dict[int, mmap.mmap] = {}
+        self.active: Union[BinaryIO, None] = None
+        self.active_id = 0
+        self.active_size = 0
+        # Closed packs whose data is not known to be on disk yet.
+        self.unsynced: Set[int] = set()
+        self.lock = asyncio.Lock()
+        self.scheduler = None
+
+    def packPath(self, pack: int) -> str:
+        return os.path.join(self.packs, f"{pack:08d}.pack")
+
+    async def init(self) -> None:
+        await self.files.init()
+        os.makedirs(self.packs, exist_ok=True)
+        await asyncio.to_thread(self.load)
+        if not self.scheduler and not self.readonly:
+            settings = Config.settings.advanced.pack
+            self.scheduler = scheduler.add_job(
+                self.flush, IntervalTrigger(seconds=settings.flush_interval)
+            )
+            scheduler.add_job(
+                self.compact, IntervalTrigger(seconds=settings.compact_interval)
+            )
+        logger.tinfo(
+            "storage.info.pack.loaded",
+            count=self.index[1] + len(self.pending),
+            packs=len(self.live),
+        )
+
+    def load(self) -> None:
+        active, covered = 0, 0
+        if self.mapIndex():
+            _, _, _, active, covered = INDEX_HEADER.unpack_from(self.index[0])
+        packs = sorted(int(path.stem) for path in Path(self.packs).glob("*.pack"))
+        if self.readonly:
+            for pack in packs:
+                if pack >= active:
+                    self.recover(pack, covered if pack == active else 0)
+            return
+        for pack in packs:
+            self.live[pack] = 0
+        for _, pack, _, length in self.records():
+            self.live[pack] = self.live.get(pack, 0) + length
+        # Files appended after the index was saved.
+        for pack in packs:
+            if pack >= active:
+                self.recover(pack, covered if pack == active else 0)
+        self.active_id = max(packs, default=0)
+        self.live.setdefault(self.active_id, 0)
+        self.active = open(self.packPath(self.active_id), "ab")
+        self.active_size = self.active.tell()
+
+    def mapIndex(self) -> bool:
+        try:
+            with open(self.index_path, "rb") as f:
+                st = os.fstat(f.fileno())
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.index = (b"", 0)
+            return False
+        self.stamp = (st.st_ino, st.st_mtime_ns)
+        magic, version, count, _, _ = (
+            INDEX_HEADER.unpack_from(index)
+            if len(index) >= INDEX_HEADER.size
+            else (b"", 0, 0, 0, 0)
+        )
+        if magic != MAGIC or version != VERSION:
+            self.index = (b"", 0)
+            return False
+        self.index = (index, count)
+        return True
+
+    def refresh(self, force: bool = False) -> None:
+        """
+        In a worker, map the index again once the primary has saved a new one
+        and collect the files appended since. Checked at most once a second
+        unless forced.
+        """
+        now = time.monotonic()
+        if not force and now - self.refreshed < 1:
+            return
+        self.refreshed = now
+        try:
+            st = os.stat(self.index_path)
+        except OSError:
+            st = None
+        if st is not None and (st.st_ino, st.st_mtime_ns) != self.stamp:
+            # The new index covers the files collected so far.
+            self.pending, self.tails, self.maps = {}, {}, {}
+            self.load()
+            return
+        last = max(self.tails, default=-1)
+        for pack in sorted(int(path.stem) for path in Path(self.packs).glob("*.pack")):
+            if pack in self.tails or pack > last:
+                self.recover(pack, self.tails.get(pack, 0))
+
+    def recover(self, pack: int, start: int) -> None:
+        path = self.packPath(pack)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            # Compacted away by the primary.
+            return
+        offset = start
+        with open(path, "rb") as f:
+            f.seek(start)
+            while offset + ENTRY.size <= size:
+                key, length = ENTRY.unpack(f.read(ENTRY.size))
+                if offset + ENTRY.size + length > size:
+                    break
+                self.put(key, (pack, offset + ENTRY.size, length))
+                offset += ENTRY.size + length
+                f.seek(offset)
+        if self.readonly:
+            # The primary may still be writing the rest.
+            self.tails[pack] = offset
+        elif offset < size:
+            # Torn write at the end of the pack.
+            os.truncate(path, offset)
+
+    def records(self) -> Iterator[Tuple[bytes, int, int, int]]:
+        index, count = self.index
+        if not count:
+            return iter(())
+        end = INDEX_HEADER.size + count * RECORD.size
+        return RECORD.iter_unpack(memoryview(index)[INDEX_HEADER.size : end])
+
+    def find(self, key: bytes) -> Union[Location, None]:
+        location = self.lookup(key)
+        if location is None and self.readonly:
+            self.refresh()
+            location = self.lookup(key)
+        return location
+
+    def lookup(self, key: bytes) -> Union[Location, None]:
+        location = self.pending.get(key)
+        if location is not None:
+            return location
+        index, count = self.index
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            start = INDEX_HEADER.size + middle * RECORD.size
+            found = index[start : start + KEY_SIZE]
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return RECORD.unpack_from(index, start)[1:]
+        return None
+
+    def locate(self, key: bytes) -> Union[Tuple[Location, memoryview], None]:
+        location = self.find(key)
+        if location is None:
+            return None
+        try:
+            return location, self.view(*location)
+        except FileNotFoundError:
+            if not self.readonly:
+                raise
+        # The primary compacted the pack away after this worker mapped the
+        # index, the new index points at the file's new place.
+        self.refresh(force=True)
+        location = self.lookup(key)
+        if location is None:
+            return None
+        return location, self.view(*location)
+
+    def put(self, key: bytes, location: Location) -> None:
+        old = self.lookup(key)
+        if old is not None:
+            self.live[old[0]] = self.live.get(old[0], 0) - old[2]
+        self.pending[key] = location
+        self.live[location[0]] = self.live.get(location[0], 0) + location[2]
+
+    def view(self, pack: int, offset: int, length: int) -> memoryview:
+        if not length:
+            return memoryview(b"")
+        mapping = self.maps.get(pack)
+        if mapping is None or len(mapping) < offset + length:
+            # The active pack grows, map it again to see the new files.
+            with open(self.packPath(pack), "rb") as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[pack] = mapping
+        return memoryview(mapping)[offset : offset + length]
+
+    def append(self, key: bytes, data: memoryview) -> None:
+        assert self.active is not None
+        limit = Config.settings.advanced.pack.pack_size
+        if self.active_size and self.active_size + ENTRY.size + len(data) > limit:
+            self.unsynced.add(self.active_id)
+            self.active.close()
+            self.active_id += 1
+            self.active = open(self.packPath(self.active_id), "ab")
+            self.active_size = 0
+        self.active.write(ENTRY.pack(key, len(data)))
+        self.active.write(data)
+        self.active.flush()
+        offset = self.active_size + ENTRY.size
+        self.active_size = offset + len(data)
+        self.put(key, (self.active_id, offset, len(data)))
+
+    def save(self, remove: AbstractSet[bytes] = frozenset()) -> None:
+        # The index must never point at data that isn't on disk.
+        assert self.active is not None
+        os.fsync(self.active.fileno())
+        for pack in sorted(self.unsynced):
+            try:
+                fd = os.open(self.packPath(pack), os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.unsynced.clear()
+        pending = self.pending.copy()
+        added = sorted(
+            (key, *location) for key, location in pending.items() if key not in remove
+        )
+        kept = (
+            record
+            for record in self.records()
+            if record[0] not in pending and record[0] not in remove
+        )
+        temp = self.index_path + ".tmp"
+        count = 0
+        with open(temp, "wb") as f:
+            f.write(INDEX_HEADER.pack(MAGIC, VERSION, 0, 0, 0))
+            for record in heapq.merge(kept, added):
+                f.write(RECORD.pack(*record))
+                count += 1
+            f.seek(0)
+            f.write(
+                INDEX_HEADER.pack(
+                    MAGIC, VERSION, count, self.active_id, self.active_size
+                )
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.index_path)
+        self.mapIndex()
+        self.pending = {}
+
+    async def flush(self) -> None:
+        if self.pending:
+            async with self.lock:
+                await asyncio.to_thread(self.save)
+
+    async def check(self) -> None:
+        await self.files.check()
+
+    async def writeFile(
+        self, file: FileInfo, content: io.BytesIO, delay: int, retry: int
+    ) -> bool:
+        key = toKey(file.hash)
+        if key is None or file.size > Config.settings.advanced.pack.max_object:
+            return await self.files.writeFile(file, content, delay, retry)
+        location = self.find(key)
+        if location is not None and location[2] == file.size:
+            return True
+        data = content.getbuffer()
+        if len(data) != file.size:
+            logger.terror(
+                "storage.error.pack.write_file.size_mismatch",
+                file=file.hash,
+                file_size=humanize.naturalsize(file.size, binary=True),
+                actual_file_size=humanize.naturalsize(len(data), binary=True),
+            )
+            return False
+        for _ in range(retry):
+            try:
+                async with self.lock:
+                    await asyncio.to_thread(self.append, key, data)
+                return True
+            except Exception as e:
+                logger.terror(
+                    "storage.error.pack.write_file.retry",
+                    file=file.hash,
+                    e=e,
+                    retry=delay,
+                )
+            await asyncio.sleep(delay)
+        logger.terror("storage.error.pack.write_file.failed", file=file.hash)
+        return False
+
+    async def getMissingFiles(self, files: FileList, pbar: tqdm) -> FileList:
+        max_object = Config.settings.advanced.pack.max_object
+
+        def lookup() -> Tuple[List[FileInfo], List[FileInfo]]:
+            missing, plain = [], []
+            for file in files.files:
+                key = toKey(file.hash)
+                if key is None or file.size > max_object:
+                    plain.append(file)
+                    continue
+                location = self.find(key)
+                if location is None or location[2] != file.size:
+                    missing.append(file)
+                pbar.update(1)
+            return missing, plain
+
+        missing, plain = await asyncio.to_thread(lookup)
+        if plain:
+            missing += (await self.files.getMissingFiles(FileList(plain), pbar)).files
+        return FileList(files=missing)
+
+    async def readFile(self, hash: str) -> Union[bytes, None]:
+        key = toKey(hash)
+        found = self.locate(key) if key else None
+        if found is None:
+            return await self.files.readFile(hash)
+        return bytes(found[1])
+
+    def mapFile(self, hash: str) -> Union[memoryview, None]:
+        key = toKey(hash)
+        found = self.locate(key) if key else None
+        if found is None:
+            return self.files.mapFile(hash)
+        return found[1]
+
+    async def quarantineFile(self, hash: str) -> bool:
+        key = toKey(hash)
+        if key is None or self.find(key) is None:
+            return await self.files.quarantineFile(hash)
+        async with self.lock:
+            await asyncio.to_thread(self.quarantine, key, hash)
+        return True
+
+    def quarantine(self, key: bytes, hash: str) -> None:
+        location = self.find(key)
+        if location is None:
+            return
+        directory = os.path.join(self.path, "quarantine")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, hash), "wb") as f:
+            f.write(self.view(*location))
+        self.live[location[0]] -= location[2]
+        self.pending.pop(key, None)
+        self.save({key})
+
+    async def express(
+        self, hash: str, counter: dict
+    ) -> Union[web.Response, web.FileResponse]:
+        key = toKey(hash)
+        try:
+            found = self.locate(key) if key else None
+        except Exception as e:
+            logger.debug(e)
+            return web.HTTPInternalServerError(text=str(e))
+        if found is None:
+            return await self.files.express(hash, counter)
+        (_, _, length), view = found
+        response = BufferResponse(view)
+        response.headers["x-bmclapi-hash"] = hash
+        counter["bytes"] += length
+        counter["hits"] += 1
+        return response
+
+    async def recycleFiles(self, files: FileList) -> None:
+        keys = {toKey(file.hash) for file in files.files}
+        hashes = {file.hash for file in files.files}
+
+        def collect() -> Tuple[int, int]:
+            remove: Set[bytes] = set()
+            size = 0
+            for key, pack, _, length in self.records():
+                if key not in keys and key not in self.pending:
+                    remove.add(key)
+                    self.live[pack] -= length
+                    size += length
+            for key, (pack, _, length) in self.pending.items():
+                if key not in keys:
+                    remove.add(key)
+                    self.live[pack] -= length
+                    size += length
+            if remove:
+                self.save(remove)
+            count = len(remove)
+            for path in Path(self.path).glob("??/*"):
+                if path.name not in hashes and path.is_file():
+                    size += path.stat().st_size
+                    count += 1
+                    path.unlink()
+            return count, size
+
+        async with self.lock:
+            count, size = await asyncio.to_thread(collect)
+        if not count:
+            logger.tinfo("storage.success.local.no_need_to_recycle")
+            return
+        logger.tsuccess(
+            "storage.success.local.recycled",
+            size=humanize.naturalsize(size, binary=True),
+        )
+
+    async def compact(self) -> None:
+        """
+        Rewrite packs that are mostly garbage, moving their live files to the
+        active pack. The old pack is only removed once the index points away
+        from it, responses still sending from its mapping keep working.
+        """
+        ratio = Config.settings.advanced.pack.compact_ratio
+        async with self.lock:
+            for pack in [pack for pack in self.live if pack != self.active_id]:
+                size = os.path.getsize(self.packPath(pack))
+                if size and self.live[pack] / size >= ratio:
+                    continue
+                freed = size - self.live[pack]
+                try:
+                    moved = await asyncio.to_thread(self.compactPack, pack)
+                    logger.tsuccess(
+                        "storage.success.pack.compacted",
+                        pack=pack,
+                        count=moved,
+                        size=humanize.naturalsize(freed, binary=True),
+                    )
+                except Exception as e:
+                    logger.terror("storage.error.pack.compact", pack=pack, e=e)
+
+    def compactPack(self, pack: int) -> int:
+        locations = [
+            (key, (pack, offset, length))
+            for key, found, offset, length in self.records()
+            if found == pack
+        ] + [
+            (key, location)
+            for key, location in self.pending.items()
+            if location[0] == pack
+        ]
+        moved = 0
+        for key, location in locations:
+            if self.find(key) == location:
+                self.append(key, self.view(*location))
+                moved += 1
+        self.save()
+        self.maps.pop(pack, None)
+        del self.live[pack]
+        os.unlink(self.packPath(pack))
+        return moved
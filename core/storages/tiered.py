@@ -0,0 +1,219 @@
+from core.classes import Storage, FileInfo, FileList
+from core.storages.local import LocalStorage
+from core.sketch import SpaceSaving
+from core.logger import logger
+from core.config import Config
+from core import metrics
+from collections import OrderedDict
+from typing import Dict, List, Set, Tuple, Union
+from pathlib import Path
+from tqdm import tqdm
+from aiohttp import web
+import asyncio
+import humanize
+import io
+import os
+
+
+class TieredStorage(Storage):
+    """
+    A bounded local cache in front of a remote origin.
+
+    The origin holds every file and receives all synchronised writes. Files
+    that keep being requested are copied to the cache in the background and
+    served from there with sendfile, everything else is served by the origin.
+    When the cache is full the least recently served files are evicted.
+
+    With workers, only the primary process promotes and evicts, so the cache
+    stays within `size` however many processes serve it. Workers serve any
+    file they find in the cache and report their downloads to the primary,
+    which counts them through `observe`.
+    """
+
+    def __init__(
+        self, cache: LocalStorage, origin: Storage, size: int, readonly: bool = False
+    ) -> None:
+        self.cache = cache
+        self.origin = origin
+        self.size = size
+        self.readonly = readonly
+        self.used = 0
+        # hash -> size, least recently served first
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.candidates = SpaceSaving(Config.settings.advanced.tiered.candidates)
+        self.promoting: Set[str] = set()
+        self.tasks: Set[asyncio.Task] = set()
+        self.semaphore = asyncio.Semaphore(
+            Config.settings.advanced.tiered.promote_concurrency
+        )
+        metrics.tiered_cache_bytes.setFunction(lambda: self.used)
+
+    async def init(self) -> None:
+        await asyncio.gather(self.cache.init(), self.origin.init())
+        if self.readonly:
+            return
+        entries = await asyncio.to_thread(self.scan)
+        for hash, size in entries.items():
+            self.entries[hash] = size
+            self.used += size
+        self.evict(0)
+        logger.tinfo(
+            "storage.info.tiered.loaded",
+            count=len(self.entries),
+            size=humanize.naturalsize(self.used, binary=True),
+            total=humanize.naturalsize(self.size, binary=True),
+        )
+
+    def scan(self) -> Dict[str, int]:
+        files = []
+        for path in Path(self.cache.path).glob("??/*"):
+            if path.name.startswith(".") or path.suffix == ".tmp":
+                # Temporary files are left behind by writes that never finished.
+                if path.suffix == ".tmp":
+                    try:
+                        path.unlink()
+                    except OSError:
+                        pass
+                continue
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            files.append((st.st_atime, path.name, st.st_size))
+        files.sort()
+        return {name: size for _, name, size in files}
+
+    async def check(self) -> None:
+        await self.cache.check()
+        await self.origin.check()
+
+    async def writeFile(
+        self, file: FileInfo, content: io.BytesIO, delay: int, retry: int
+    ) -> bool:
+        return await self.origin.writeFile(file, content, delay, retry)
+
+    async def getMissingFiles(self, files: FileList, pbar: tqdm) -> FileList:
+        return await self.origin.getMissingFiles(files, pbar)
+
+    async def readFile(self, hash: str) -> Union[bytes, None]:
+        if hash in self.entries:
+            content = await self.cache.readFile(hash)
+            if content is not None:
+                return content
+        return await self.origin.readFile(hash)
+
+    def mapFile(self, hash: str) -> Union[memoryview, None]:
+        if self.readonly:
+            return self.cache.mapFile(hash)
+        return self.cache.mapFile(hash) if hash in self.entries else None
+
+    async def quarantineFile(self, hash: str) -> bool:
+        # The origin still has a good copy.
+        self.discard(hash)
+        return False
+
+    async def express(
+        self, hash: str, counter: dict
+    ) -> Union[web.Response, web.FileResponse]:
+        if self.readonly:
+            response = await self.cache.express(hash, counter)
+            if response.status == 200:
+                metrics.tiered_requests.labels("hit").inc()
+                return response
+            metrics.tiered_requests.labels("miss").inc()
+            return await self.origin.express(hash, counter)
+
+        if hash in self.entries:
+            self.entries.move_to_end(hash)
+            response = await self.cache.express(hash, counter)
+            if response.status == 200:
+                metrics.tiered_requests.labels("hit").inc()
+                return response
+            # Removed behind our back, forget it and go to the origin.
+            self.discard(hash)
+
+        metrics.tiered_requests.labels("miss").inc()
+        self.candidates.add(hash)
+        self.consider(hash)
+        return await self.origin.express(hash, counter)
+
+    def observe(self, entries: List[Tuple[str, int, int, int]]) -> None:
+        """
+        Counts downloads served by the workers, as reported in hot files.
+        """
+        for hash, count, _, _ in entries:
+            if hash in self.entries:
+                self.entries.move_to_end(hash)
+            else:
+                self.candidates.add(hash, 0, count)
+                self.consider(hash)
+
+    def consider(self, hash: str) -> None:
+        # Count minus error is a lower bound of the real number of requests.
+        hits = self.candidates.counts[hash] - self.candidates.errors[hash]
+        if (
+            hits >= Config.settings.advanced.tiered.promote_after
+            and hash not in self.promoting
+        ):
+            self.promoting.add(hash)
+            task = asyncio.create_task(self.promote(hash))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def promote(self, hash: str) -> None:
+        try:
+            async with self.semaphore:
+                if hash in self.entries:
+                    return
+                content = await self.origin.readFile(hash)
+                if content is None or len(content) > self.size:
+                    metrics.tiered_promotions.labels("skipped").inc()
+                    return
+                size = len(content)
+                self.evict(size)
+                # Reserve the space so concurrent promotions do not overshoot.
+                self.used += size
+                file = FileInfo(path="", hash=hash, size=size, mtime=-1)
+                written = False
+                try:
+                    written = await self.cache.writeFile(
+                        file, io.BytesIO(content), 0, 1
+                    )
+                finally:
+                    if written:
+                        self.entries[hash] = size
+                    else:
+                        self.used -= size
+                metrics.tiered_promotions.labels(
+                    "success" if written else "failed"
+                ).inc()
+        except Exception as e:
+            metrics.tiered_promotions.labels("failed").inc()
+            logger.terror("storage.error.tiered.promote", file=hash, e=e)
+        finally:
+            self.promoting.discard(hash)
+
+    def evict(self, incoming: int) -> None:
+        while self.entries and self.used + incoming > self.size:
+            hash, size = self.entries.popitem(last=False)
+            self.remove(hash)
+            self.used -= size
+
+    def discard(self, hash: str) -> None:
+        size = self.entries.pop(hash, None)
+        if size is not None:
+            self.remove(hash)
+            self.used -= size
+
+    def remove(self, hash: str) -> None:
+        try:
+            # Responses already being sent keep the open file.
+            os.unlink(os.path.join(self.cache.path, hash[:2], hash))
+        except OSError:
+            pass
+
+    async def recycleFiles(self, files: FileList) -> None:
+        await self.origin.recycleFiles(files)
+        valid = {file.hash for file in files.files}
+        for hash in [hash for hash in self.entries if hash not in valid]:
+            self.discard(hash)
@@ -0,0 +1,79 @@
+from core.config import Config
+from core.logger import logger
+from typing import Tuple
+import asyncio
+import os
+import ssl
+
+
+def createContext(cert: str, key: str) -> ssl.SSLContext:
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.check_hostname = False
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    # Forward-secret AEAD suites only, TLS 1.3 suites are not affected.
+    context.set_ciphers(Config.settings.advanced.tls.ciphers)
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    tickets = Config.settings.advanced.tls.session_tickets
+    if tickets > 0:
+        context.num_tickets = tickets
+    else:
+        context.options |= ssl.OP_NO_TICKET
+    context.load_cert_chain(certfile=cert, keyfile=key)
+    return context
+
+
+class CertificateReloader:
+    """
+    Serves the certificate on disk without restarting the listener.
+
+    The listening context never changes. Its SNI callback, which OpenSSL runs
+    for every handshake, moves the connection onto the newest context, so
+    reloads only affect new connections and in-flight downloads keep going.
+    """
+
+    def __init__(self, cert: str, key: str) -> None:
+        self.cert = cert
+        self.key = key
+        self.current = createContext(cert, key)
+        self.mtime = self.stat()
+        self.context = createContext(cert, key)
+        self.context.sni_callback = self.select
+        self.task: asyncio.Task | None = None
+
+    def select(
+        self,
+        ssl_object: ssl.SSLObject,
+        server_name: str | None,
+        context: ssl.SSLContext,
+    ) -> None:
+        if self.current is not context:
+            ssl_object.context = self.current
+
+    def stat(self) -> Tuple[float, float]:
+        try:
+            return os.stat(self.cert).st_mtime, os.stat(self.key).st_mtime
+        except OSError:
+            return 0.0, 0.0
+
+    def reload(self) -> None:
+        try:
+            self.current = createContext(self.cert, self.key)
+        except (OSError, ssl.SSLError) as e:
+            # Keep serving the old certificate until a valid pair is in place.
+            logger.terror("tls.error.reload", e=e)
+            return
+        logger.tsuccess("tls.success.reloaded")
+
+    async def watch(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            mtime = self.stat()
+            if mtime != self.mtime:
+                # A broken pair is retried once the files change again.
+                self.mtime = mtime
+                self.reload()
+
+    def start(self) -> None:
+        interval = Config.settings.advanced.tls.reload_interval
+        if interval > 0 and self.task is None:
+            self.task = asyncio.create_task(self.watch(interval))
@@ -0,0 +1,9 @@
+import tomllib
+
+
+def readVersion() -> str:
+    with open("pyproject.toml", "rb") as f:
+        return tomllib.load(f)["tool"]["poetry"]["version"]
+
+
+VERSION = readVersion()
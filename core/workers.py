@@ -0,0 +1,225 @@
+from core.cluster import Cluster
+from core.logger import logger
+from core.exceptions import ConfigValueError
+from core.performance import loopFactory
+from core.sketch import SpaceSaving
+from core.storages import TieredStorage
+from core import metrics
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+from multiprocessing.sharedctypes import Synchronized, SynchronizedArray
+from typing import TYPE_CHECKING, List, Tuple
+import multiprocessing
+import asyncio
+import os
+import queue
+import signal
+import socket
+import tempfile
+import time
+
+if TYPE_CHECKING:
+    from core.router import Router
+
+# hits, bytes, open transfers
+SLOTS = 3
+# Seconds between reports of a worker to the primary process.
+REPORT_INTERVAL = 5
+
+
+def reusePortSupported() -> bool:
+    return hasattr(socket, "SO_REUSEPORT")
+
+
+class WorkerPool:
+    """
+    Serves downloads from extra processes sharing the listening port.
+
+    Only the primary process answers the status, metrics and admin
+    endpoints, workers forward them over a private unix socket. Workers
+    publish their totals through a shared array and send their hot files,
+    user agents and metrics to the primary through a queue, where they are
+    merged and persisted.
+    """
+
+    def __init__(self, count: int, router: "Router") -> None:
+        self.count = count
+        self.router = router
+        self.context = multiprocessing.get_context("spawn")
+        # Every worker owns SLOTS slots holding its running totals of hits
+        # and bytes and its open transfers. Only the owner writes to them, so
+        # no lock is needed.
+        self.slots = self.context.Array("q", count * SLOTS, lock=False)
+        self.enabled = self.context.Value("b", 0, lock=False)
+        self.queue = self.context.Queue()
+        self.path = os.path.join(
+            tempfile.gettempdir(), f"openbmclapi-{os.getpid()}.sock"
+        )
+        self.seen = [0] * (count * SLOTS)
+        self.processes: List[BaseProcess | None] = [None] * count
+        self.https = False
+        self.port = 0
+
+    def start(self, https: bool, port: int) -> None:
+        self.https, self.port = https, port
+        logger.tinfo("workers.info.starting", count=self.count)
+        for index in range(self.count):
+            self.spawn(index)
+
+    def spawn(self, index: int) -> None:
+        process = self.context.Process(
+            target=serve,
+            args=(
+                index,
+                self.https,
+                self.port,
+                self.slots,
+                self.enabled,
+                self.queue,
+                self.path,
+            ),
+            name=f"openbmclapi-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+
+    async def supervise(self) -> None:
+        self.receive()
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logger.twarning(
+                    "workers.warn.restarting", index=index, code=process.exitcode
+                )
+                self.spawn(index)
+
+    def setEnabled(self, enabled: bool) -> None:
+        self.enabled.value = int(enabled)
+
+    def collect(self) -> Tuple[int, int]:
+        hits = bytes = 0
+        for index in range(self.count):
+            offset = index * SLOTS
+            current_hits, current_bytes = self.slots[offset], self.slots[offset + 1]
+            hits += current_hits - self.seen[offset]
+            bytes += current_bytes - self.seen[offset + 1]
+            self.seen[offset], self.seen[offset + 1] = current_hits, current_bytes
+        return hits, bytes
+
+    def connections(self) -> int:
+        return sum(self.slots[index * SLOTS + 2] for index in range(self.count))
+
+    def receive(self) -> None:
+        while True:
+            try:
+                index, hot_files, agents, snapshot = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            self.router.hot_files.merge(hot_files)
+            for storage in self.router.storages:
+                if isinstance(storage, TieredStorage):
+                    storage.observe(hot_files)
+            self.router.agents.merge(agents)
+            metrics.registry.imported[str(index)] = snapshot
+
+    def reload(self) -> None:
+        for process in self.processes:
+            if process is not None and process.pid is not None:
+                os.kill(process.pid, signal.SIGHUP)
+
+    async def stop(self, timeout: float = 10) -> None:
+        processes = [process for process in self.processes if process is not None]
+        self.processes = [None] * self.count
+        for process in processes:
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in processes:
+            # Keep reading, a worker can't exit while its last report is
+            # stuck in a full pipe.
+            while process.is_alive() and time.monotonic() < deadline:
+                await asyncio.to_thread(process.join, 0.5)
+                self.receive()
+            if process.is_alive():
+                process.kill()
+        self.receive()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def serve(
+    index: int,
+    https: bool,
+    port: int,
+    slots: SynchronizedArray,
+    enabled: Synchronized,
+    reports: Queue,
+    primary: str,
+) -> None:
+    # The primary process decides when to stop, Ctrl+C in a terminal must
+    # not kill the workers before it has collected their counters.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with asyncio.Runner(loop_factory=loopFactory()) as runner:
+        runner.run(work(index, https, port, slots, enabled, reports, primary))
+
+
+async def work(
+    index: int,
+    https: bool,
+    port: int,
+    slots: SynchronizedArray,
+    enabled: Synchronized,
+    reports: Queue,
+    primary: str,
+) -> None:
+    task = asyncio.current_task()
+    assert task is not None
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, task.cancel)
+
+    cluster = Cluster(primary)
+    offset = index * SLOTS
+    base_hits, base_bytes = slots[offset], slots[offset + 1]
+
+    def publish() -> None:
+        if cluster.router is None:
+            return
+        slots[offset] = base_hits + cluster.router.counters["hits"]
+        slots[offset + 1] = base_bytes + cluster.router.counters["bytes"]
+        slots[offset + 2] = cluster.router.connection
+
+    def report() -> None:
+        router = cluster.router
+        if router is None:
+            return
+        hot_files = router.hot_files.top()
+        router.hot_files = SpaceSaving(router.hot_files.capacity)
+        reports.put((index, hot_files, router.agents.take(), metrics.registry.export()))
+
+    try:
+        await cluster.init()
+        await cluster.setupRouter()
+        loop.add_signal_handler(signal.SIGHUP, reloadConfig, cluster)
+        await cluster.listen(https, port, reuse_port=True)
+        reported = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            cluster.enabled = bool(enabled.value)
+            publish()
+            if time.monotonic() - reported > REPORT_INTERVAL:
+                reported = time.monotonic()
+                report()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await cluster.drain()
+        publish()
+        report()
+
+
+def reloadConfig(cluster: Cluster) -> None:
+    try:
+        cluster.router.reloadConfig()
+    except ConfigValueError:
+        pass
@@ -25,6 +25,13 @@ export interface Cluster {
     }
 }
 
+export interface HotFile {
+    hash: string
+    hits: number
+    error: number
+    bytes: number
+}
+
 export interface StatsRes {
     status: number
     startTime: number
@@ -50,3 +57,7 @@ export async function fetchRank() {
     return res.data
 }
 
+export async function fetchHotFiles(limit: number = 50) {
+    const res = await axios.get<HotFile[]>('/api/hot', { params: { limit } })
+    return res.data
+}
@@ -1,7 +1,42 @@
-import { defineConfig } from 'vite'
+import { defineConfig, type Plugin } from 'vite'
 import vue from '@vitejs/plugin-vue'
+import { readdirSync, readFileSync, writeFileSync } from 'node:fs'
+import { join } from 'node:path'
+import { brotliCompressSync, constants, gzipSync } from 'node:zlib'
+
+// Ship .gz/.br next to the bundle so the node doesn't have to compress at startup.
+function precompress(): Plugin {
+  let outDir = 'dist'
+  return {
+    name: 'precompress',
+    apply: 'build',
+    configResolved(config) {
+      outDir = config.build.outDir
+    },
+    closeBundle() {
+      const walk = (dir: string) => {
+        for (const entry of readdirSync(dir, { withFileTypes: true })) {
+          const path = join(dir, entry.name)
+          if (entry.isDirectory()) {
+            walk(path)
+          } else if (/\.(html|js|css|svg|json|ttf|eot)$/.test(entry.name)) {
+            const data = readFileSync(path)
+            writeFileSync(`${path}.gz`, gzipSync(data, { level: 9 }))
+            writeFileSync(
+              `${path}.br`,
+              brotliCompressSync(data, {
+                params: { [constants.BROTLI_PARAM_QUALITY]: 11 },
+              }),
+            )
+          }
+        }
+      }
+      walk(outDir)
+    },
+  }
+}
 
 // https://vite.dev/config/
 export default defineConfig({
-  plugins: [vue()],
+  plugins: [vue(), precompress()],
 })